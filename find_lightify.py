@@ -1,22 +1,16 @@
 #!/usr/bin/python3
 
+import sys
+
 from jubilee import lights
 
-base_address = '192.168.1.'
+# network to search may be given as argument in CIDR notation, e.g. 192.168.1.0/24
+network = sys.argv[1] if len(sys.argv) > 1 else '192.168.1.0/27'
 
-success = False
+gateways = lights.find_lightify_gateways(network)
 
-for i in range(32):
-	ip = base_address + str(i)
-	lightify = lights.LightifyGateway(ip)
-	try:
-		lightify.get_all_lights()
-	except:
-		pass
-	else:
-		print("Found Lightify Gateway at: {}".format(ip))
-		success = True
-		break
+for ip in gateways:
+	print("Found Lightify Gateway at: {}".format(ip))
 
-if not success:
+if not gateways:
 	print('Lightify Gateway not found!')
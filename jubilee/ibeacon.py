@@ -9,6 +9,11 @@ import logging
 import struct
 import json
 import os
+import binascii
+import collections
+import queue
+import select
+import selectors
 
 DEVNULL = open(os.devnull, 'wb')	# /dev/null
 PLATFORM = os.uname()[0]
@@ -16,29 +21,261 @@ PLATFORM = os.uname()[0]
 # set up logging
 logger = logging.getLogger(__name__)
 
-class Scanner():
+# header of an HCI event packet containing a single LE advertising report
+# (packet type, LE meta event, parameter length, advertising report subevent, number of reports)
+IBEACON_PREFIX = b'\x04\x3e\x2a\x02\x01'
+# same header as it appears at the start of a line of `hcidump --raw` output
+IBEACON_PREFIX_HEX = b'> 04 3E 2A 02 01'
+# iBeacon type and length fields of manufacturer specific data
+IBEACON_TYPE = b'\x02\x15'
+IBEACON_TYPE_OFFSET = 21
+
+# UUID, Major, Minor, (measured power), RSSI from an iBeacon advertising report
+ADVERT = struct.Struct('>23x16sHHxb')
+
+# length prefix of each JSON message sent to or from clients
+FRAME_HEADER = struct.Struct('<H')
+# compact binary advert record (UUID, Major, Minor, RSSI, scanner monotonic timestamp),
+# sent without a length prefix once a client has negotiated the binary wire format
+ADVERT_RECORD = struct.Struct('<16sHHbd')
+
+Advert = collections.namedtuple('Advert', ('uuid', 'major', 'minor', 'rssi'))
+
+# formatted UUID strings, keyed by raw 16-byte UUID
+_uuid_strings = {}
+
+def parse_packet(packet):
+	"""
+	Parse iBeacon advertisement from a raw HCI event packet (bytes, bytearray or memoryview).
+	Returns an Advert tuple (raw 16-byte UUID, Major, Minor, RSSI), or None if the packet
+	is not an iBeacon advertisement.
+	"""
+	if (len(packet) < ADVERT.size
+		or packet[:5] != IBEACON_PREFIX
+		or packet[IBEACON_TYPE_OFFSET:IBEACON_TYPE_OFFSET+2] != IBEACON_TYPE):
+		return None
+	return Advert._make(ADVERT.unpack_from(packet))
+
+def format_uuid(uuid):
+	"""
+	Return raw 16-byte UUID as an upper case string in 8-4-4-4-12 format
+	"""
+	try:
+		return _uuid_strings[uuid]
+	except KeyError:
+		h = binascii.hexlify(uuid).decode('ascii').upper()
+		s = '-'.join((h[0:8], h[8:12], h[12:16], h[16:20], h[20:32]))
+		_uuid_strings[bytes(uuid)] = s
+		return s
+
+def hcidump_packets(stream):
+	"""
+	Yield raw HCI packets containing iBeacon adverts from the output of `hcidump --raw`.
+	Packets which don't start with the iBeacon header are skipped without being decoded.
+	"""
+	packet = None
+	for line in stream:
+		if line[:1] in (b'>', b'<'):	# signifies start of next packet
+			if packet:
+				yield bytes(packet)
+			if line.startswith(IBEACON_PREFIX_HEX):
+				packet = bytearray()
+			else:
+				packet = None
+		if packet is not None:
+			try:
+				packet += binascii.unhexlify(line.translate(None, b' >\r\n'))
+			except binascii.Error:
+				logger.debug('Could not parse line: %s' % (line))
+				packet = None
+	if packet:
+		yield bytes(packet)
+
+def json_frame(msg):
+	"""
+	Return dict encoded as a JSON message with length prefix
+	"""
+	data = json.dumps(msg, separators=(',', ':')).encode('utf-8')
+	return FRAME_HEADER.pack(len(data)) + data
+
+def h4_packets(stream):
+	"""
+	Yield raw HCI event packets from a binary stream of packets in H4 format (packet type,
+	event code, parameter length, parameters), as read from an HCI socket
+	"""
+	while True:
+		header = stream.read(3)
+		if len(header) < 3:
+			return
+		params = stream.read(header[2])
+		if len(params) < header[2]:
+			return
+		yield header + params
+
+
+# Linux bluetooth socket constants (not defined by python builds without bluetooth support)
+AF_BLUETOOTH = getattr(socket, 'AF_BLUETOOTH', 31)
+BTPROTO_HCI = getattr(socket, 'BTPROTO_HCI', 1)
+SOL_HCI = getattr(socket, 'SOL_HCI', 0)
+HCI_FILTER = getattr(socket, 'HCI_FILTER', 2)
+
+HCI_COMMAND_PKT = 0x01
+HCI_EVENT_PKT = 0x04
+EVT_LE_META_EVENT = 0x3E
+OGF_LE_CTL = 0x08
+OCF_LE_SET_SCAN_PARAMETERS = 0x000B
+OCF_LE_SET_SCAN_ENABLE = 0x000C
+
+# HCI socket filter (packet type mask, event mask, opcode)
+HCI_FILTER_STRUCT = struct.Struct('<IIIH')
+# HCI command packet header (packet type, opcode, parameter length)
+HCI_COMMAND = struct.Struct('<BHB')
+
+
+class HcidumpSource():
 	"""
-	Listen for ibeacon advertisements and send them to each client
+	Capture HCI packets using `hcitool lescan` and `hcidump --raw` subprocesses
 	"""
 	def __init__(self, hci='hci0'):
+		self.hci = hci
+
+	def open(self):
+		# start scanning for bluetooth packets in subprocess
+		self.lescan_p = subprocess.Popen(['hcitool', '-i', self.hci, 'lescan', '--duplicates'], stdout=DEVNULL)
+		# start hcidump to pipe raw bluetooth packets		
+		logger.debug("Running on Linux...")
+		hcidump_args = ['hcidump', '--raw', '-i', self.hci]
+		self.hcidump_p = subprocess.Popen(hcidump_args, stdout=subprocess.PIPE)
+
+	def packets(self):
+		return hcidump_packets(self.hcidump_p.stdout)
+
+	def close(self):
+		self.hcidump_p.terminate()
+		self.lescan_p.terminate()
+
+
+class HCISocketSource():
+	"""
+	Capture LE meta events directly from a raw HCI socket, and enable LE scanning on the
+	adapter by sending HCI commands on the same socket (Linux only, requires CAP_NET_RAW).
+	Reads time out every `poll_interval` seconds to check whether the source has been 
+	closed, as closing the socket doesn't wake a thread blocked reading it.
+	"""
+	def __init__(self, hci='hci0', active=False, interval=0x0010, window=0x0010, poll_interval=0.5):
+		self.dev_id = int(hci.replace('hci', ''))
+		self.poll_interval = poll_interval
+		self.closed = False
+		self.active = active
+		self.interval = interval
+		self.window = window
+		self.buf = bytearray(260)
+
+	def open(self):
+		self.closed = False
+		self.sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+		self.sock.bind((self.dev_id,))
+		# only pass LE meta events up from the kernel
+		event_mask = 1 << (EVT_LE_META_EVENT - 32)
+		self.sock.setsockopt(SOL_HCI, HCI_FILTER, HCI_FILTER_STRUCT.pack(1 << HCI_EVENT_PKT, 0, event_mask, 0))
+		# disable scanning before changing parameters, then enable scanning without duplicate filtering
+		self._send_command(OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0))
+		self._send_command(OCF_LE_SET_SCAN_PARAMETERS, struct.pack('<BHHBB', int(self.active), self.interval, self.window, 0, 0))
+		self._send_command(OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 1, 0))
+		self.sock.settimeout(self.poll_interval)
+		logger.debug('Scanning on hci%s' % (self.dev_id))
+
+	def packets(self):
+		# packets are yielded as views on a reused buffer, so must be parsed before the next is read
+		view = memoryview(self.buf)
+		while not self.closed:
+			try:
+				n = self.sock.recv_into(self.buf)
+			except socket.timeout:
+				continue
+			except OSError:
+				# socket closed
+				return
+			if n == 0:
+				return
+			yield view[:n]
+
+	def close(self):
+		self.closed = True
+		try:
+			self._send_command(OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0))
+		except OSError:
+			pass
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.sock.close()
+
+	def _send_command(self, ocf, params):
+		opcode = (OGF_LE_CTL << 10) | ocf
+		self.sock.send(HCI_COMMAND.pack(HCI_COMMAND_PKT, opcode, len(params)) + params)
+
+
+class FileSource():
+	"""
+	Replay HCI event packets from a recorded binary stream in H4 format (e.g. for testing).
+	Supply the path to the recording or an open binary file object.
+	"""
+	def __init__(self, f):
+		self.f = f
+
+	def open(self):
+		if isinstance(self.f, str):
+			self.stream = open(self.f, 'rb')
+		else:
+			self.stream = self.f
+
+	def packets(self):
+		return h4_packets(self.stream)
+
+	def close(self):
+		self.stream.close()
+
+
+class Scanner():
+	"""
+	Listen for ibeacon advertisements and send them to each client.
+	Packets are captured from `source` (HcidumpSource for the given interface by default,
+	or HCISocketSource or FileSource).
+	By default each client is served by its own thread (`server='threaded'`).  Up to 
+	`queue_size` messages are queued for each client.  If a client falls behind, either the 
+	'oldest' queued message or the 'newest' message is dropped (`drop_policy`).
+	With `server='selector'`, all clients are served from a single thread using non-blocking
+	sockets, and up to `buffer_size` bytes are buffered for each client.
+	"""
+	def __init__(self, hci='hci0', source=None, queue_size=1000, drop_policy='oldest', server='threaded', buffer_size=65536):
 		
 		# bluetooth interface
 		self.hci = hci
+		# source of raw HCI packets
+		if source is None:
+			source = HcidumpSource(hci)
+		self.source = source
 		
 		# list to hold client connections
 		self.clients = []
+		self.queue_size = queue_size
+		self.drop_policy = drop_policy
+
+		if server not in ('threaded', 'selector'):
+			raise ValueError('Invalid server mode: %s' % (server))
+		self.server = server
+		self.buffer_size = buffer_size
+		self.selector_server = None
 
 		# events used to stop child threads
 		self.stop_event = threading.Event()
 				
 	def start(self, host='localhost', port=9999):
 
-		# start scanning for bluetooth packets in subprocess
-		self.lescan_p = subprocess.Popen(['hcitool', '-i', self.hci, 'lescan', '--duplicates'], stdout=DEVNULL)
-		# start hcidump to pipe raw bluetooth packets		
-		logger.debug("Running on Linux...")
-		hcidump_args = ['hcidump', '--raw', '-i', self.hci]
-		self.hcidump_p = subprocess.Popen(hcidump_args, stdout=subprocess.PIPE)
+		# start capturing bluetooth packets
+		self.source.open()
 
 		self.scan_thread = threading.Thread(target=self.scan_loop)
 		self.scan_thread.start()
@@ -51,9 +288,13 @@ class Scanner():
 		self.s.settimeout(5)
 		self.s.bind(server_address)
 		# listen for incoming connections
-		self.s.listen(1)
+		self.s.listen(16)
 
-		self.server_thread = threading.Thread(target=self.wait_for_connections)
+		if self.server == 'selector':
+			self.selector_server = _SelectorServer(self.s, self.stop_event, self.buffer_size)
+			self.server_thread = threading.Thread(target=self.selector_server.run)
+		else:
+			self.server_thread = threading.Thread(target=self.wait_for_connections)
 		self.server_thread.start()		
 
 	def wait_for_connections(self):
@@ -65,50 +306,64 @@ class Scanner():
 			except socket.timeout:
 				pass
 			else:
-				client = _ClientConnection(conn, client_address)
+				client = _ClientConnection(conn, client_address, self.queue_size, self.drop_policy)
 				self.clients.append(client)
 				client.start()
+			# remove connections to clients which have disconnected
+			self.clients = [c for c in self.clients if c.is_alive()]
 		logger.debug('Server stopped')
 			
 	def scan_loop(self):
 		"""
 		Parse ibeacon advertisements from bluetooth packets
 		"""
-		packet = ''
-		while not self.stop_event.isSet():
-			line = str(self.hcidump_p.stdout.readline(), encoding='utf-8')
-			line = line.replace(' ','').strip('\n')
-			if line != '' and line[0] == '>':	# signifies start of next packet
-				line = line[1:]	# trim leading '>'
-				if packet != '':
-					logger.debug(packet)
-					# check this is an ibeacon packet by checking the first 5 bytes
-					if packet.find('043E2A0201') == 0:
-						uuid = '-'.join((packet[46:54], packet[54:58], packet[58:62], packet[62:66], packet[66:78]))
-						major = int(packet[78:82], base=16)
-						minor = int(packet[82:86], base=16)
-						rssi = int(packet[88:90], base=16) - 256
-						msg = '{"UUID":"%s","Major":"%s","Minor":"%s","RSSI":%s}' % (uuid, major, minor, rssi)
-						for client in self.clients:
-							client.add_to_queue(msg)
-						logger.debug(msg)
-				packet = ''	# empty string ready for next packet
-			packet += line
+		for packet in self.source.packets():
+			if self.stop_event.isSet():
+				break
+			advert = parse_packet(packet)
+			if advert is None:
+				continue
+			message = _Message(advert, time.monotonic())
+			if self.selector_server is not None:
+				self.selector_server.add_to_queue(message)
+			else:
+				for client in self.clients:
+					client.add_to_queue(message)
+			logger.debug(advert)
 		logger.debug('Scanner stopped')
 				
 	def stop(self):
 		self.stop_event.set()
+		self.source.close()
 		self.scan_thread.join()
 		self.server_thread.join()
 		for client in self.clients:
 			client.join()
 		print('Bye!')
+
+	def stats(self):
+		"""
+		Return numbers of messages sent to and dropped for each connected client
+		"""
+		if self.selector_server is not None:
+			return self.selector_server.stats()
+		return {'%s:%s' % c.client_address: {'sent': c.sent, 'dropped': c.dropped} for c in self.clients}
 		
 
 class Client():
-	def __init__(self, server_address, on_message=None):
+	"""
+	Connect to ibeacon server and call `on_message` with each advert received, as a dict with
+	keys "UUID", "Major", "Minor" and "RSSI" (and "Time", the scanner's monotonic timestamp,
+	if `binary` is True).
+	If `binary` is True, the compact binary wire format is negotiated with the server, 
+	otherwise adverts are received in JSON format.
+	If `subscribe` is supplied, only adverts from matching beacons are received (see 
+	Client.subscribe()).  `on_connect` is called with the Client object once connected.
+	"""
+	def __init__(self, server_address, on_message=None, binary=False, subscribe=None, interval=None, on_connect=None):
 		self.server_address = server_address
 		self.message_handler = on_message
+		self.binary = False
 		
 		# create a TCP/IP socket
 		self.s = _Socket()
@@ -119,46 +374,312 @@ class Client():
 		logger.debug('Connected!')
 
 		try:
-			while True:
-				data = self.s.recv(2)
-				(packet_len,) = struct.unpack('<H',data)
-				packet = self.s.recv(packet_len)
-				msg = json.loads(str(packet, encoding='utf-8'))
-				self.message_handler(msg)
-		
+			if binary:
+				self.s.send(json_frame({'format': 'binary'}))
+			if (subscribe is not None) or (interval is not None):
+				self.subscribe(subscribe, interval)
+			if on_connect is not None:
+				on_connect(self)
+			self._loop()
 		finally:
 			self.s.close()
+
+	def subscribe(self, beacons=None, interval=None):
+		"""
+		Ask server to only forward adverts from the given beacons, at most once every 
+		`interval` seconds per beacon.  Each beacon may be a dict with keys "UUID", "Major" 
+		and "Minor", a (UUID, Major, Minor) tuple, or a string to match all beacons with UUIDs
+		starting with the given prefix.  If `beacons` is None, adverts from all beacons are 
+		forwarded.
+		"""
+		msg = {'subscribe': None, 'interval': interval}
+		if beacons is not None:
+			msg['subscribe'] = []
+			for b in beacons:
+				if isinstance(b, dict):
+					b = (b['UUID'], b['Major'], b['Minor'])
+				msg['subscribe'].append(b)
+		self.s.send(json_frame(msg))
+
+	def _loop(self):
+		buf = bytearray()
+		while True:
+			buf += self.s.recv_some()
+			if not self.binary:
+				buf = self._handle_json(buf)
+			if self.binary:
+				buf = self._handle_binary(buf)
+
+	def _handle_json(self, buf):
+		"""
+		Handle complete JSON messages in buffer and return remaining data
+		"""
+		pos = 0
+		while len(buf) - pos >= FRAME_HEADER.size:
+			(packet_len,) = FRAME_HEADER.unpack_from(buf, pos)
+			end = pos + FRAME_HEADER.size + packet_len
+			if len(buf) < end:
+				break
+			msg = json.loads(buf[pos+FRAME_HEADER.size:end].decode('utf-8'))
+			pos = end
+			if 'format' in msg:
+				# server has acknowledged request to change format
+				logger.debug('Receiving adverts in %s format' % (msg['format']))
+				self.binary = (msg['format'] == 'binary')
+				if self.binary:
+					break
+			else:
+				self.message_handler(msg)
+		return buf[pos:]
+
+	def _handle_binary(self, buf):
+		"""
+		Handle all complete binary advert records in buffer and return remaining data
+		"""
+		end = len(buf) - len(buf) % ADVERT_RECORD.size
+		for (uuid, major, minor, rssi, t) in ADVERT_RECORD.iter_unpack(memoryview(buf)[:end]):
+			self.message_handler({"UUID": format_uuid(uuid), "Major": str(major), "Minor": str(minor), "RSSI": rssi, "Time": t})
+		return buf[end:]
 	
-			
+
+class _Message():
+	"""
+	An advert to be sent to clients, encoded in each wire format on first use only
+	"""
+	__slots__ = ('advert', 'time', '_json', '_binary')
+
+	def __init__(self, advert, time):
+		self.advert = advert
+		self.time = time
+		self._json = None
+		self._binary = None
+
+	def json(self):
+		if self._json is None:
+			a = self.advert
+			msg = ('{"UUID":"%s","Major":"%s","Minor":"%s","RSSI":%s}' % (format_uuid(a.uuid), a.major, a.minor, a.rssi)).encode('utf-8')
+			self._json = FRAME_HEADER.pack(len(msg)) + msg
+		return self._json
+
+	def binary(self):
+		if self._binary is None:
+			a = self.advert
+			self._binary = ADVERT_RECORD.pack(a.uuid, a.major, a.minor, a.rssi, self.time)
+		return self._binary
+
+
+class _Session():
+	"""
+	Wire format and subscription negotiated by a client.  Clients may send JSON control 
+	messages with a length prefix at any time:
+	- {"format": "binary"} to switch to the binary format.  The server acknowledges a change 
+	  of format by replying with the same message, after which adverts are sent to the 
+	  client as binary records.
+	- {"subscribe": [...], "interval": seconds} to only receive adverts from beacons in the
+	  list, each given as [UUID, Major, Minor] or a UUID prefix string, and at most once per 
+	  interval for each beacon.  A null subscription or interval removes the restriction.
+	"""
+	# maximum number of cached subscription matches per client
+	MAX_MATCHES = 1024
+
+	def __init__(self, client_address):
+		self.client_address = client_address
+		self.binary = False
+		self._buf = bytearray()
+		# set of subscribed (UUID, Major, Minor) tuples and tuple of subscribed UUID prefixes,
+		# or None if subscribed to all beacons
+		self.beacons = None
+		self.prefixes = ()
+		# cached results of matching beacon IDs against subscription
+		self._matches = {}
+		# minimum interval between adverts from each beacon, and time last advert was sent
+		self.interval = None
+		self._last_sent = {}
+
+	def feed(self, data):
+		"""
+		Parse control messages received from client.  Returns reply to be sent to client 
+		before any further adverts.
+		"""
+		self._buf += data
+		reply = b''
+		while len(self._buf) >= FRAME_HEADER.size:
+			(msg_len,) = FRAME_HEADER.unpack_from(self._buf)
+			if len(self._buf) < FRAME_HEADER.size + msg_len:
+				break
+			try:
+				msg = json.loads(self._buf[FRAME_HEADER.size:FRAME_HEADER.size+msg_len].decode('utf-8'))
+			except ValueError:
+				logger.warning('Invalid message from client at %s' % (self.client_address[0]))
+				msg = {}
+			del self._buf[:FRAME_HEADER.size+msg_len]
+			reply += self._update(msg)
+		return reply
+
+	def _update(self, msg):
+		reply = b''
+		if not isinstance(msg, dict):
+			logger.warning('Invalid message from client at %s' % (self.client_address[0]))
+			return reply
+		if 'subscribe' in msg:
+			self._subscribe(msg['subscribe'])
+		if 'interval' in msg:
+			self._set_interval(msg['interval'])
+		fmt = msg.get('format')
+		if fmt == 'binary' and not self.binary:
+			logger.debug('Client at %s switched to binary format' % (self.client_address[0]))
+			reply = json_frame({'format': 'binary'})
+			self.binary = True
+		elif fmt is not None and fmt != 'binary':
+			logger.warning('Unsupported format requested by client at %s: %s' % (self.client_address[0], fmt))
+		return reply
+
+	def _subscribe(self, subscription):
+		if subscription is None:
+			beacons = None
+			prefixes = ()
+		else:
+			beacons = set()
+			prefixes = []
+			try:
+				for b in subscription:
+					if isinstance(b, str):
+						prefixes.append(b.replace('-', '').upper())
+					else:
+						(uuid, major, minor) = b
+						beacons.add((bytes.fromhex(uuid.replace('-', '')), int(major), int(minor)))
+			except (TypeError, ValueError):
+				logger.warning('Invalid subscription from client at %s: %s' % (self.client_address[0], subscription))
+				return
+			prefixes = tuple(prefixes)
+		logger.debug('Client at %s subscribed to %s' % (self.client_address[0], subscription))
+		self._matches = {}
+		self.prefixes = prefixes
+		self.beacons = beacons
+
+	def _set_interval(self, requested):
+		interval = None
+		if requested is not None:
+			try:
+				interval = float(requested)
+			except (TypeError, ValueError):
+				interval = -1
+			if not interval >= 0:
+				logger.warning('Invalid interval from client at %s: %s' % (self.client_address[0], requested))
+				return
+		self.interval = interval
+		self._last_sent = {}
+
+	def match(self, message):
+		"""
+		Return True if advert should be forwarded to the client
+		"""
+		a = message.advert
+		key = (a.uuid, a.major, a.minor)
+		if self.beacons is not None:
+			matched = self._matches.get(key)
+			if matched is None:
+				matched = (key in self.beacons) or format_uuid(a.uuid).replace('-', '').startswith(self.prefixes)
+				if len(self._matches) >= self.MAX_MATCHES:
+					self._matches = {}
+				self._matches[key] = matched
+			if not matched:
+				return False
+		if self.interval:
+			last_sent = self._last_sent.get(key)
+			if (last_sent is not None) and (message.time - last_sent < self.interval):
+				return False
+			self._last_sent[key] = message.time
+		return True
+
+	def encode(self, message):
+		"""
+		Return advert encoded in the format negotiated by the client
+		"""
+		if self.binary:
+			return message.binary()
+		return message.json()
+
+
 class _ClientConnection(threading.Thread):
 	"""
-	Send ibeacon advertisements to client
+	Send ibeacon advertisements to client.
+	Adverts are queued in a bounded FIFO queue and everything queued is encoded and sent
+	to the client in a single call to sendall() each time the connection thread wakes up.
 	"""
-	def __init__(self, conn, client_address):
+	def __init__(self, conn, client_address, queue_size=1000, drop_policy='oldest'):
 		super(_ClientConnection, self).__init__()
 		self.conn = conn
 		self.client_address = client_address
 		print('Connection received from %s' % (client_address[0]))		
-		self.queue = []
+		if drop_policy not in ('oldest', 'newest'):
+			raise ValueError('Invalid drop policy: %s' % (drop_policy))
+		self.queue = queue.Queue(queue_size)
+		self.drop_policy = drop_policy
+		self.session = _Session(client_address)
+		# numbers of messages sent to client and dropped because the queue was full
+		self.sent = 0
+		self.dropped = 0
 		self.stoprequest = threading.Event()
 	
 	def run(self):
 		while not self.stoprequest.isSet():
-			if len(self.queue) != 0:
-				msg = self.queue.pop()
-				msg_len = len(msg)
-				data = struct.pack('<H', msg_len) + msg.encode('utf-8')
-				logger.debug('Sending: %s' % (data))
-				try:
-					self.conn.sendall(data)
-				except BrokenPipeError:
-					logger.debug('Client at %s disconnected unexpectedly' % (self.client_address[0]))
+			try:
+				if not self._read_from_client():
+					logger.debug('Client at %s disconnected' % (self.client_address[0]))
 					break
+				try:
+					messages = [self.queue.get(timeout=0.5)]
+				except queue.Empty:
+					continue
+				# coalesce everything else that has been queued in the meantime
+				while True:
+					try:
+						messages.append(self.queue.get_nowait())
+					except queue.Empty:
+						break
+				data = b''.join([self.session.encode(m) for m in messages])
+				logger.debug('Sending %s messages (%s bytes)' % (len(messages), len(data)))
+				self.conn.sendall(data)
+			except (BrokenPipeError, ConnectionResetError):
+				logger.debug('Client at %s disconnected unexpectedly' % (self.client_address[0]))
+				break
+			self.sent += len(messages)
 		self.conn.close()
-		print('Connection to client at %s lost' % (self.client_address[0]))
+		print('Connection to client at %s lost (sent: %s, dropped: %s)' % (self.client_address[0], self.sent, self.dropped))
 	
-	def add_to_queue(self, packet):
-		self.queue.append(packet)
+	def _read_from_client(self):
+		"""
+		Handle any control messages waiting to be read from client without blocking.
+		Return False if client has disconnected.
+		"""
+		readable, _, _ = select.select([self.conn], [], [], 0)
+		if readable:
+			data = self.conn.recv(4096)
+			if data == b'':
+				return False
+			reply = self.session.feed(data)
+			if reply:
+				self.conn.sendall(reply)
+		return True
+
+	def add_to_queue(self, message):
+		if not self.session.match(message):
+			return
+		try:
+			self.queue.put_nowait(message)
+		except queue.Full:
+			self.dropped += 1
+			if self.drop_policy == 'oldest':
+				# discard the message at the head of the queue to make room
+				try:
+					self.queue.get_nowait()
+				except queue.Empty:
+					pass
+				try:
+					self.queue.put_nowait(message)
+				except queue.Full:
+					pass
 	
 	def join(self, timeout=None):
 		logger.debug('Stopping connection thread')
@@ -166,6 +687,176 @@ class _ClientConnection(threading.Thread):
 		super(_ClientConnection, self).join(timeout)
 
 
+class _BufferedClient():
+	"""
+	Connection to a client served by _SelectorServer, with an output buffer
+	"""
+	def __init__(self, conn, client_address):
+		self.conn = conn
+		self.client_address = client_address
+		self.session = _Session(client_address)
+		self.buf = bytearray()
+		# numbers of messages sent to client and dropped because the buffer was full
+		self.sent = 0
+		self.dropped = 0
+		# number of messages wholly or partly in output buffer
+		self.buffered = 0
+
+
+class _SelectorServer():
+	"""
+	Accept connections and send ibeacon advertisements to all clients from a single thread
+	using non-blocking sockets.  Messages are added by the scan thread and the server thread
+	is woken up via a socket pair.  Disconnected clients are removed automatically.
+	"""
+	def __init__(self, sock, stop_event, buffer_size=65536):
+		self.s = sock
+		self.s.setblocking(False)
+		self.stop_event = stop_event
+		self.buffer_size = buffer_size
+		self.sel = selectors.DefaultSelector()
+		self.sel.register(self.s, selectors.EVENT_READ, self._accept)
+		# messages waiting to be sent to clients and socket pair to wake server thread
+		self.pending = collections.deque()
+		self._wake_r, self._wake_w = socket.socketpair()
+		self._wake_r.setblocking(False)
+		self._wake_w.setblocking(False)
+		self._woken = False
+		self.sel.register(self._wake_r, selectors.EVENT_READ, self._wake)
+		# dict from sockets to connected clients
+		self.clients = {}
+
+	def add_to_queue(self, message):
+		"""
+		Queue advert to be sent to all clients (called from scan thread)
+		"""
+		self.pending.append(message)
+		if not self._woken:
+			self._woken = True
+			try:
+				self._wake_w.send(b'\0')
+			except BlockingIOError:
+				pass
+
+	def run(self):
+		print('Waiting for connections...')
+		while not self.stop_event.isSet():
+			for key, mask in self.sel.select(timeout=0.5):
+				key.data(key.fileobj, mask)
+		for client in list(self.clients.values()):
+			self._disconnect(client)
+		self.sel.close()
+		self._wake_r.close()
+		self._wake_w.close()
+		logger.debug('Server stopped')
+
+	def stats(self):
+		return {'%s:%s' % c.client_address: {'sent': c.sent, 'dropped': c.dropped} for c in list(self.clients.values())}
+
+	def _accept(self, sock, mask):
+		try:
+			conn, client_address = sock.accept()
+		except BlockingIOError:
+			return
+		print('Connection received from %s' % (client_address[0]))
+		conn.setblocking(False)
+		client = _BufferedClient(conn, client_address)
+		self.clients[conn] = client
+		self.sel.register(conn, selectors.EVENT_READ, self._service)
+
+	def _wake(self, sock, mask):
+		try:
+			sock.recv(4096)
+		except BlockingIOError:
+			pass
+		self._woken = False
+		messages = []
+		while True:
+			try:
+				messages.append(self.pending.popleft())
+			except IndexError:
+				break
+		if len(messages) == 0:
+			return
+		for client in list(self.clients.values()):
+			if self.clients.get(client.conn) is not client:
+				# disconnected while handling this batch
+				continue
+			frames = [client.session.encode(m) for m in messages if client.session.match(m)]
+			if len(frames) == 0:
+				continue
+			data = b''.join(frames)
+			if len(client.buf) + len(data) <= self.buffer_size:
+				client.buf += data
+				client.buffered += len(frames)
+			else:
+				# buffer as many messages as will fit and drop the rest
+				for frame in frames:
+					if len(client.buf) + len(frame) <= self.buffer_size:
+						client.buf += frame
+						client.buffered += 1
+					else:
+						client.dropped += 1
+			self._flush(client)
+
+	def _service(self, conn, mask):
+		client = self.clients.get(conn)
+		if client is None:
+			# disconnected earlier in the same batch of events
+			return
+		if mask & selectors.EVENT_READ:
+			try:
+				data = conn.recv(4096)
+			except BlockingIOError:
+				data = None
+			except OSError:
+				data = b''
+			if data == b'':
+				logger.debug('Client at %s disconnected' % (client.client_address[0]))
+				self._disconnect(client)
+				return
+			if data:
+				reply = client.session.feed(data)
+				if reply:
+					# send reply ahead of any adverts encoded in the new format
+					client.buf += reply
+					self._flush(client)
+					return
+		if mask & selectors.EVENT_WRITE:
+			self._flush(client)
+
+	def _flush(self, client):
+		"""
+		Send as much of the client's output buffer as possible without blocking
+		"""
+		if self.clients.get(client.conn) is not client:
+			return
+		try:
+			n = client.conn.send(client.buf)
+		except BlockingIOError:
+			n = 0
+		except OSError:
+			logger.debug('Client at %s disconnected unexpectedly' % (client.client_address[0]))
+			self._disconnect(client)
+			return
+		del client.buf[:n]
+		if len(client.buf) == 0:
+			client.sent += client.buffered
+			client.buffered = 0
+			events = selectors.EVENT_READ
+		else:
+			events = selectors.EVENT_READ | selectors.EVENT_WRITE
+		if self.sel.get_key(client.conn).events != events:
+			self.sel.modify(client.conn, events, self._service)
+
+	def _disconnect(self, client):
+		if self.clients.pop(client.conn, None) is None:
+			return
+		self.sel.unregister(client.conn)
+		client.conn.close()
+		print('Connection to client at %s lost (sent: %s, dropped: %s)' % (client.client_address[0], client.sent, client.dropped))
+
+
 class _Socket():
 	"""
 	Simple socket class
@@ -183,7 +874,7 @@ class _Socket():
 		totalsent = 0
 		while totalsent < len(msg):
 			sent = self.sock.send(msg[totalsent:])
-			print('Sent: %s' % (sent))
+			logger.debug('Sent: %s' % (sent))
 			if sent == 0:
 				raise RuntimeError('socket connection broken')
 			totalsent = totalsent + sent
@@ -198,6 +889,12 @@ class _Socket():
 			chunks.append(chunk)
 			bytes_recd = bytes_recd + len(chunk)
 		return b''.join(chunks)
+
+	def recv_some(self, max_len=65536):
+		chunk = self.sock.recv(max_len)
+		if chunk == b'':
+			raise RuntimeError('socket connection broken')
+		return chunk
 		
 	def close(self):
 		self.sock.close()
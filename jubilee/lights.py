@@ -1,13 +1,17 @@
 # Built-in modules
-import json, datetime, calendar, subprocess, signal, time, os, logging, threading, queue
-import socket, binascii, struct
+import json, datetime, subprocess, signal, time, os, logging, threading, queue, contextlib
+import socket, binascii, struct, collections, heapq, itertools
+import concurrent.futures, ipaddress, array, bisect, zoneinfo
 
 # Installed modules
 import paho.mqtt.client as mqtt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Package modules
 from . import uid as uid_module
+from . import sun
 
 # Import config
 import config
@@ -29,15 +33,27 @@ v1.0.0	HueLight & Bridge classes
 
 logger = logging.getLogger(__name__)
 
+# file for Bridge fast start cache, if not set in config
+DEFAULT_BRIDGE_CACHE = 'bridge_cache.json'
+
+def _bridge_cache_path():
+	return getattr(config, 'BRIDGE_CACHE', DEFAULT_BRIDGE_CACHE)
+
 class DaylightSensor():
 	"""
 	Implement a daylight sensor
-	Sunrise and sunset times are retrieved for the specified location (lat/lon)
+	Sunrise, sunset and twilight times are calculated for the specified location (lat/lon),
+	from a table computed for the whole year (see jubilee.sun)
 	If no location is supplied, attempts to find location from IP address using ipinfo.org
 	query() method returns true if daylight, false if not
+	If cross_check is True, calculated times are checked against sunrise-sunset.org in a 
+	background thread
+	elevation() method returns the elevation of the sun, interpolated from a table for the 
+	day at intervals of ELEVATION_STEP minutes
 	"""
+	ELEVATION_STEP = 5
 	
-	def __init__(self, lat=None, lon=None):
+	def __init__(self, lat=None, lon=None, cross_check=False):
 		"""
 		Initialise sensor
 		"""		
@@ -48,13 +64,19 @@ class DaylightSensor():
 			ipinfo = requests.get('https://ipinfo.io/geo').json()
 			self.lat = ipinfo["loc"].split(',')[0]
 			self.lng = ipinfo["loc"].split(',')[1]
+		self.lat = float(self.lat)
+		self.lng = float(self.lng)
 		
 		logger.debug('Daylight sensor initialised for latitude: %s, longitude: %s' % (self.lat, self.lng))
 
-		# initialise sunrise & sunset times
-		self.update_daylight_due = datetime.datetime.now() + datetime.timedelta(hours=24)
-		now = datetime.datetime.now()
-		self.daylight_times = self._get_daylight_times(date=now)
+		# table of daylight times for this year
+		self.table = sun.SunTable(datetime.date.today().year, self.lat, self.lng)
+		# table of sun elevations for one day (UTC)
+		self.elevation_date = None
+		self.elevations = None
+
+		if cross_check:
+			threading.Thread(target=self._cross_check, daemon=True).start()
 
 	def query(self, time=None):
 		"""
@@ -64,54 +86,86 @@ class DaylightSensor():
 		if time is None:
 			time = datetime.datetime.utcnow()
 		
-		# update daylight times if >24 hours old
-		if time > self.update_daylight_due:
-			self.daylight_times = self._get_daylight_times(date=time)
-		
-		# ensure daylight times are same day as query time		
-		sunrise = self.daylight_times['sunrise'].replace(time.year, time.month, time.day)
-		sunset = self.daylight_times['sunset'].replace(time.year, time.month, time.day)
-		
-		# return True if time is between sunrise and sunset, False otherwise
-		if (time > sunrise) and (time < sunset):
-			return True
-		else:
-			return False
+		# return True if sun is above horizon, False otherwise
+		return sun.elevation(time, self.lat, self.lng) > sun.SUNRISE
 
 	def sunrise(self):
 		"""
-		Return stored sunrise time as datetime object
+		Return today's sunrise time (UTC) as datetime object
 		"""
-		# update daylight times if >24 hours old
-		if datetime.datetime.utcnow() > self.update_daylight_due:
-			self.daylight_times = self._get_daylight_times()
-		# ensure daylight times are today
-		today = datetime.datetime.today()	
-		sunrise = self.daylight_times['sunrise'].replace(today.year, today.month, today.day)
-		# return sunrise
-		return sunrise
+		return self.times()['sunrise']
 
 	def sunset(self):
 		"""
-		Return stored sunset time as datetime object
+		Return today's sunset time (UTC) as datetime object
+		"""
+		return self.times()['sunset']
+
+	def times(self, date=None):
+		"""
+		Return dict from event names (sunrise, sunset, civil_dawn, civil_dusk, nautical_dawn,
+		nautical_dusk) to UTC datetimes on date (default today), or None if the event doesn't
+		happen on that date
+		"""
+		if date is None:
+			date = datetime.date.today()
+		if date.year != self.table.year:
+			self.table = sun.SunTable(date.year, self.lat, self.lng)
+		return self.table.times(date)
+
+	def elevation(self, time=None):
+		"""
+		Return elevation of the sun in degrees at time (UTC, default now)
 		"""
-		# update daylight times if >24 hours old
-		if datetime.datetime.utcnow() > self.update_daylight_due:
-			self.daylight_times = self._get_daylight_times()
-		# ensure daylight times are today
-		today = datetime.datetime.today()	
-		sunset = self.daylight_times['sunset'].replace(today.year, today.month, today.day)
-		# return sunset
-		return sunset
+		if time is None:
+			time = datetime.datetime.utcnow()
+		if time.date() != self.elevation_date:
+			self._update_elevations(time.date())
+		(i, fraction) = divmod((time.hour * 60 + time.minute + time.second / 60) / self.ELEVATION_STEP, 1)
+		i = int(i)
+		return self.elevations[i] + fraction * (self.elevations[i + 1] - self.elevations[i])
+
+	def elevation_time(self, elevation, rising, date=None):
+		"""
+		Return time (UTC) on date (default today) at which the sun rises (rising=True) or 
+		sets through elevation in degrees, or None if it doesn't on that date
+		"""
+		if date is None:
+			date = datetime.date.today()
+		(rise, set_) = sun.crossing_times(date, self.lat, self.lng, elevation)
+		return rise if rising else set_
+
+	def _update_elevations(self, date):
+		# calculate elevations at each step from midnight to midnight (UTC) on date
+		midnight = datetime.datetime(date.year, date.month, date.day)
+		step = datetime.timedelta(minutes=self.ELEVATION_STEP)
+		self.elevations = array.array('d', (sun.elevation(midnight + i * step, self.lat, self.lng) 
+			for i in range(24 * 60 // self.ELEVATION_STEP + 1)))
+		self.elevation_date = date
+
+	def _cross_check(self, tolerance=datetime.timedelta(minutes=5)):
+		"""
+		Compare today's calculated sunrise and sunset times with sunrise-sunset.org
+		"""
+		date = datetime.datetime.utcnow()
+		web_times = self._get_daylight_times(date=date)
+		if web_times is None:
+			return
+		times = self.times(date.date())
+		for event in ('sunrise', 'sunset'):
+			if (times[event] is None) or (abs(times[event] - web_times[event]) > tolerance):
+				logger.warning('Calculated %s time %s differs from sunrise-sunset.org (%s)' % (event, times[event], web_times[event]))
+			else:
+				logger.debug('Calculated %s time %s agrees with sunrise-sunset.org (%s)' % (event, times[event], web_times[event]))
 
 	def _get_daylight_times(self, date=None):
 		"""
 		Return sunrise and sunset times from sunrise-sunset.org as datetime objects
 		"""
-		logger.debug('Updating sunrise and sunset times...')
+		logger.debug('Getting sunrise and sunset times from sunrise-sunset.org...')
 		if date is None:
 			date = datetime.datetime.utcnow()
-		payload = {'lat': self.lat, 'lng': self.lng, 'date': date.isoformat()}
+		payload = {'lat': self.lat, 'lng': self.lng, 'date': date.date().isoformat()}
 		try:
 			r = requests.get('http://api.sunrise-sunset.org/json', params=payload, timeout=30)
 			r.raise_for_status()
@@ -119,70 +173,106 @@ class DaylightSensor():
 			sunset_str = r.json()['results']['sunset']
 		except (requests.exceptions.HTTPError, requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
 			logger.warning("Could not connect to sunrise-sunset.org (%s)" % (err))
-			return self.daylight_times
+			return None
 		sunrise = datetime.datetime.strptime(sunrise_str,'%I:%M:%S %p').replace(date.year, date.month, date.day)
 		sunset = datetime.datetime.strptime(sunset_str,'%I:%M:%S %p').replace(date.year, date.month, date.day)
-		logger.info('New daylight times (UTC) (sunrise: %s, sunset: %s), next update due at %s' % (sunrise, sunset, self.update_daylight_due))
-		self.update_daylight_due = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+		logger.info('Daylight times (UTC) from sunrise-sunset.org (sunrise: %s, sunset: %s)' % (sunrise, sunset))
 
 		return {'sunrise': sunrise, 'sunset': sunset}
 
 
-class UKTimeZone(datetime.tzinfo):
+class LocalTimeZone():
 	"""
-	Support conversion between local UK time and UTC.
-	British Summer Time (BST) begins at 01:00 GMT on the last Sunday of March and ends at 01:00 GMT 
-	(02:00 BST) on the last Sunday of October.  Local UK time is one hour ahead of UTC during BST and 
-	equal to UTC outside BST.
+	Support conversion between UTC and local time in an IANA time zone (e.g. 'Europe/London').
+	The times of changes in UTC offset (e.g. to and from daylight saving time) are found once
+	for the current and next year, so conversions only need a binary search.  All datetimes
+	are naive.
 	"""
-	def __init__(self):
-		# UTC offset outside British Summer Time (BST)
-		self.__OFFSET = datetime.timedelta(0)
-
-	def tzname(dt):
-		"""
-		Return name of time zone ('Europe/London')
-		"""
-		return 'Europe/London'
-
-	def utcoffset(self, dt):
-		"""
-		Return offset between UTC and local time in UK (at time supplied as argument) in minutes east of UTC
-		"""
-		return self.__OFFSET + self.dst(dt)
-		
-	def dst(self, dt):
-		"""
-		Return Daylight Savings Time (DST) adjustment in minutes east of UTC
-		"""
-		# get start and end of Daylight Savings Time
-		year = dt.year
-		last_sunday_mar = max(week[-1] for week in calendar.monthcalendar(year, 3))
-		last_sunday_oct = max(week[-1] for week in calendar.monthcalendar(year, 10))
-
-		DST_START = datetime.datetime(year=year, month=3, day=last_sunday_mar, hour=1)
-		DST_END = datetime.datetime(year=year, month=10, day=last_sunday_oct, hour=1)
-		
-		DST_OFFSET = -60
-
-		if DST_START <= dt < DST_END:
-			return datetime.timedelta(minutes=DST_OFFSET)
-		else:
-			return datetime.timedelta(0)
+	def __init__(self, zone='Europe/London', year=None):
+		self.zone = zoneinfo.ZoneInfo(zone)
+		if year is None:
+			year = datetime.datetime.utcnow().year
+		self._find_transitions(year)
+
+	def tzname(self):
+		"""
+		Return name of time zone
+		"""
+		return self.zone.key
+
+	def utcoffset(self, utc):
+		"""
+		Return offset of local time from UTC (local - UTC) at UTC time supplied as argument
+		"""
+		if not (self.start <= utc < self.end):
+			self._find_transitions(utc.year)
+		return self.offsets[bisect.bisect_right(self.transitions, utc)]
+
+	def to_local(self, utc):
+		"""
+		Return local time for UTC time
+		"""
+		return utc + self.utcoffset(utc)
+
+	def to_utc(self, local):
+		"""
+		Return UTC time for local time.  Ambiguous local times (when the clocks go back) are
+		taken as the first occurrence, and local times skipped when the clocks go forward are
+		taken as the same time after the change in offset.
+		"""
+		candidates = sorted(set(local - offset for offset in (self.utcoffset(local - datetime.timedelta(days=1)),
+			self.utcoffset(local + datetime.timedelta(days=1)))))
+		for utc in candidates:
+			if self.to_local(utc) == local:
+				return utc
+		# skipped local time
+		return candidates[-1]
+
+	def _find_transitions(self, year):
+		# find UTC times at which the offset changes between start of year and end of next 
+		# year, by checking offset daily then bisecting to the second
+		self.start = datetime.datetime(year, 1, 1)
+		self.end = datetime.datetime(year + 2, 1, 1)
+		offset = lambda utc: utc.replace(tzinfo=datetime.timezone.utc).astimezone(self.zone).utcoffset()
+		self.transitions = []
+		self.offsets = [offset(self.start)]
+		day = self.start
+		while day < self.end:
+			next_day = day + datetime.timedelta(days=1)
+			if offset(next_day) != self.offsets[-1]:
+				(lo, hi) = (day, next_day)
+				while hi - lo > datetime.timedelta(seconds=1):
+					mid = lo + (hi - lo) / 2
+					if offset(mid) == self.offsets[-1]:
+						lo = mid
+					else:
+						hi = mid
+				hi = hi.replace(microsecond=0)
+				self.transitions.append(hi)
+				self.offsets.append(offset(hi))
+			day = next_day
+		logger.debug('UTC offset changes in %s: %s' % (self.zone.key, list(zip(self.transitions, self.offsets[1:]))))
 
 
 class Controller():
 	"""
 	Implement a controller to initiate actions on bridge based on time-based rules
-	Usage: call tick() method in a loop to check rules and take predefined actions
+	Usage: call loop_once() method in a loop to take predefined actions when due, and 
+	sleep_until_next() between calls.
+	Rules are planned once a day into a heap of UTC trigger times.  The plan is rebuilt at
+	local midnight, when the UTC offset changes, and when rules are reloaded.
+	Times in rules are local times in `timezone` (IANA name).
+	Rules may be triggered when the sun rises or sets through a given elevation, and 
+	daylight curve rules set the brightness and colour temperature of lights at regular 
+	intervals according to the elevation of the sun.
 	"""
 	
-	def __init__(self, bridge, rules, daylight_sensor, presence_sensor=None):
+	def __init__(self, bridge, rules, daylight_sensor, presence_sensor=None, timezone='Europe/London'):
 		"""
 		Initialise controller and read rules from file
 		"""
-		# UK time zone object
-		self.tz = UKTimeZone()
+		# local time zone object
+		self.tz = LocalTimeZone(timezone)
 		
 		if isinstance(bridge, Bridge):
 			self.bridge = bridge
@@ -200,64 +290,161 @@ class Controller():
 		self.last_tick_daylight = False
 		self.last_tick = datetime.datetime.utcnow()
 
-		# read rules from file
-		with open(rules, 'r') as f:
-			self.rules = json.loads(f.read())
-
 		# set up handler to parse and implement actions
 		self.action_handler = _ActionHandler(self.bridge)
+
+		# heap of (UTC trigger time, sequence number, rule) planned for today, UTC time at 
+		# which plan is due to be rebuilt, and UTC offset when planned
+		self.schedule = []
+		self._seq = itertools.count()
+		self.plan_due = self.last_tick
+		self.plan_offset = None
+		# set to wake sleep_until_next() early, e.g. when rules are reloaded
+		self._wakeup = threading.Event()
+
+		# read rules from file
+		self.load_rules(rules)
+
+	def load_rules(self, rules):
+		"""
+		Read rules from file and rebuild plan
+		"""
+		with open(rules, 'r') as f:
+			rules = json.loads(f.read())
 		
 		# change time strings in each rule to datetime objects
-		for rule in self.rules:
+		for rule in rules:
+			if 'time' not in rule:
+				continue
 			try:
 				rule['time'] = datetime.datetime.strptime(rule['time'],'%H:%M')
 			except:
 				if (rule['time'] != 'sunrise') and (rule['time'] != 'sunset'):
 					raise ValueError
+		self.rules = rules
+		# rebuild plan on next call to loop_once()
+		self.plan_due = datetime.datetime.utcnow()
+		self._wakeup.set()
 		
 	def loop_once(self):
 		"""
-		Check rules and trigger predefined actions
+		Trigger predefined actions for rules due since last call
 		"""
 		# timer
+		self._wakeup.clear()
 		now = datetime.datetime.utcnow()
 
-		# update trigger times to today before checking against time now
-		self._update_times_to_today(now)		
+		# rebuild plan at midnight or if UTC offset has changed
+		if (now >= self.plan_due) or (self.tz.utcoffset(now) != self.plan_offset):
+			self._plan(now)
+
+		# run rules with trigger times passed since last loop
+		while self.schedule and (self.schedule[0][0] <= now):
+			(trigger_time, seq, rule) = heapq.heappop(self.schedule)
+			if rule['trigger'] == 'curve':
+				rule = self._curve_action(rule, trigger_time)
+			# if using presence sensor, only apply on/off actions if at home
+			if (self.presence_sensor != None):
+				if (self.presence_sensor.query()) or (rule['action'] in ('scene', 'set', 'fade')):
+					self.action_handler.apply_action(rule)
+			else:
+				self.action_handler.apply_action(rule)						
+		
+		self.last_tick = now
+
+	def sleep_until_next(self, max_sleep=60):
+		"""
+		Sleep until next rule is due, the plan is due to be rebuilt, or rules are reloaded 
+		(at most max_sleep seconds, in case the system clock is changed)
+		"""
+		wake = self.plan_due
+		if self.schedule:
+			wake = min(wake, self.schedule[0][0])
+		delay = (wake - datetime.datetime.utcnow()).total_seconds()
+		if delay > 0:
+			self._wakeup.wait(min(delay, max_sleep))
 
-		# run rules
+	def _plan(self, now):
+		"""
+		Build heap of UTC trigger times of today's rules, from last tick until midnight
+		"""
+		today = self.tz.to_local(now)
+		schedule = []
+		# rebuild plan at next local midnight
+		midnight = datetime.datetime.combine(today.date(), datetime.time())
+		self.plan_due = self.tz.to_utc(midnight + datetime.timedelta(days=1))
 		for rule in self.rules:
 			# check rule applies today
-			if self._check_weekday(rule):
-
-				# trigger time
-				if (rule['trigger'] == 'daylight'):
-					# daylight rules: set trigger time to sunrise/sunset +/- offset (UTC)
-					if rule['time'] == 'sunrise':
-						trigger_time = self.daylight_sensor.sunrise()
-					elif rule['time'] == 'sunset':
-						trigger_time = self.daylight_sensor.sunset()
-					else:
-						logger.error('Incorrect format for rule (%s)' % (rule))
-					try:
-						# add offset in minutes
-						trigger_time += datetime.timedelta(minutes=rule['offset'])
-					except KeyError:
-						pass
-				else:
-					# timer rules: set trigger time to rule time adjusted to UTC
-					trigger_time = rule['time'] + self.tz.utcoffset(rule['time'])
-
-				# trigger rule if trigger_time has passed since last loop
-				if (self.last_tick < trigger_time) and (now > trigger_time):
-					# if using presence sensor, only apply on/off actions if at home
-					if (self.presence_sensor != None):
-						if (self.presence_sensor.query()) or (rule['action'] == 'scene'):
-							self.action_handler.apply_action(rule)
-					else:
-						self.action_handler.apply_action(rule)						
-		
-		self.last_tick = now
+			if self._check_weekday(rule, today):
+				if rule['trigger'] == 'curve':
+					# daylight curve rules: every interval from local midnight until next plan
+					interval = datetime.timedelta(minutes=rule.get('interval', 5))
+					trigger_time = self.tz.to_utc(midnight)
+					while trigger_time <= self.plan_due:
+						if trigger_time > self.last_tick:
+							schedule.append((trigger_time, next(self._seq), rule))
+						trigger_time += interval
+					continue
+				trigger_time = self._trigger_time(rule, today)
+				if (trigger_time is not None) and (trigger_time > self.last_tick):
+					schedule.append((trigger_time, next(self._seq), rule))
+		heapq.heapify(schedule)
+		self.schedule = schedule
+		self.plan_offset = self.tz.utcoffset(now)
+		logger.debug('Planned %s rules, next plan due at %s (UTC)' % (len(schedule), self.plan_due))
+
+	def _trigger_time(self, rule, today):
+		"""
+		Return UTC trigger time of rule on today's date
+		"""
+		if (rule['trigger'] == 'elevation'):
+			# elevation rules: set trigger time to time at which sun rises or sets through
+			# elevation (UTC)
+			trigger_time = self.daylight_sensor.elevation_time(rule['elevation'], rule.get('direction') == 'rising', today.date())
+		elif (rule['trigger'] == 'daylight'):
+			# daylight rules: set trigger time to sunrise/sunset +/- offset (UTC)
+			if rule['time'] in ('sunrise', 'sunset'):
+				trigger_time = self.daylight_sensor.times(today.date())[rule['time']]
+			else:
+				logger.error('Incorrect format for rule (%s)' % (rule))
+				return None
+			if trigger_time is None:
+				# no sunrise/sunset today
+				return None
+			try:
+				# add offset in minutes
+				trigger_time += datetime.timedelta(minutes=rule['offset'])
+			except KeyError:
+				pass
+		else:
+			# timer rules: set trigger time to rule time today converted to UTC
+			local_time = rule['time'].replace(today.year, today.month, today.day)
+			trigger_time = self.tz.to_utc(local_time)
+		return trigger_time
+
+	def _curve_action(self, rule, time):
+		"""
+		Return action to set brightness and colour temperature of lights from daylight 
+		curve rule at time (UTC)
+		"""
+		(bri, kelvin) = self._interpolate(rule['curve'], self.daylight_sensor.elevation(time))
+		# fade over the interval until the next update
+		transition = rule.get('transition', min(rule.get('interval', 5) * 600, 65535))
+		return {'action': 'set', 'lights': rule.get('lights', []), 'bri': bri, 'kelvin': kelvin, 'transition': transition}
+
+	@staticmethod
+	def _interpolate(curve, x):
+		"""
+		Return values at x by linear interpolation between points [x, value, ...] in curve
+		(sorted by x), using the first or last point outside the curve
+		"""
+		if x <= curve[0][0]:
+			return curve[0][1:]
+		for (p0, p1) in zip(curve, curve[1:]):
+			if x <= p1[0]:
+				fraction = (x - p0[0]) / (p1[0] - p0[0])
+				return [v0 + fraction * (v1 - v0) for (v0, v1) in zip(p0[1:], p1[1:])]
+		return curve[-1][1:]
 
 	def _check_weekday(self, rule, today=None):
 		if today is None:
@@ -269,15 +456,6 @@ class Controller():
 				return False
 		except KeyError:
 			return True
-	
-	def _update_times_to_today(self, today):
-		"""
-		Replace year, month, day with today's values, and adjust to UTC
-		"""
-		date = datetime.datetime.today()
-		for rule in self.rules:
-			if (rule['time'] != 'sunrise') and (rule['time'] != 'sunset'):
-				rule['time'] = rule['time'].replace(date.year, date.month, date.day)
 
 
 class Remote():
@@ -350,43 +528,179 @@ class _ActionHandler():
 		try:
 			logger.info('Triggered action %s at %s' % (rule, datetime.datetime.now().strftime('%a %d/%m/%Y %H:%M:%S')))
 			if rule['action'] == 'on':
-				if len(rule['lights']) == 0:
-					self.bridge.light_on([], transition=transition)
-				else:
-					for light in rule['lights']:
-						self.bridge.light_on(light, transition=transition)
+				self.bridge.light_on(rule['lights'], transition=transition)
 			if rule['action'] == 'off':
-				if len(rule['lights']) == 0:
-					self.bridge.light_off([], transition=transition)
-				else:
-					for light in rule['lights']:
-						self.bridge.light_off(light, transition=transition)
+				self.bridge.light_off(rule['lights'], transition=transition)
 			if rule['action'] == 'scene':
 				self.bridge.recall_local_scene(rule['scene'], transition=transition)
+			if rule['action'] == 'set':
+				self.bridge.light_set(rule['lights'], bri=rule.get('bri'), kelvin=rule.get('kelvin'), transition=transition)
+			if rule['action'] == 'fade':
+				# duration in minutes
+				self.bridge.fade_to_scene(rule['scene'], rule['duration'] * 60, named_lights=rule.get('lights', []), from_scene=rule.get('from_scene'))
 		except TypeError:
 			logger.error('Action failed %s' % (rule))
 	
 
-def sync(lock):
-	def _function(f):
-		def _wrapper(*args, **kargs):
-			with lock: return f(*args, **kargs)
-		return _wrapper
-	return _function
+class _RateLimiter():
+	"""
+	Limit rate of calls to wait() to a number per second (token bucket, shared by threads)
+	"""
+	def __init__(self, rate, burst=1):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def wait(self):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+			delay = -self.tokens / self.rate if self.tokens < 0 else 0
+		if delay > 0:
+			time.sleep(delay)
+
+
+class _FadeEngine():
+	"""
+	Fade lights' brightness and colour temperature from one setting to another over any
+	duration.  Every `interval` seconds a background thread sends each fading light the
+	setting it should reach by the next update, with a transition lasting until then, so
+	each light gets at most one update per interval however long the fade.  The updates
+	due at the same time are sent together using Bridge._apply_states(), so they are 
+	batched into Hue group actions and pipelined Lightify commands.  Updates which would
+	not change a light's setting are skipped.
+	"""
+	def __init__(self, bridge, interval=10):
+		self.bridge = bridge
+		self.interval = interval
+		# dict from UIDs to fades in progress
+		self.fades = {}
+		self.lock = threading.Lock()
+		self.wakeup = threading.Condition(self.lock)
+		self.thread = None
+
+	def start(self, fades, duration):
+		"""
+		Start fading lights, replacing any fades in progress for the same lights
+		
+		@param fades list of (light, (bri, kelvin) at start, (bri, kelvin) at end) with 
+			brightness in percent and colour temperature in kelvin (None if not faded)
+		@param duration length of fade in seconds
+		"""
+		now = time.monotonic()
+		with self.wakeup:
+			for (light, start, end) in fades:
+				self.fades[light.UID()] = {'light': light, 'start': start, 'end': end, 'start_time': now,
+					'duration': max(float(duration), 0.001), 'last': None}
+			if self.thread is None:
+				self.thread = threading.Thread(target=self._loop, daemon=True)
+				self.thread.start()
+			self.wakeup.notify()
+
+	def cancel(self, lights):
+		"""
+		Stop fading lights (at their current settings)
+		"""
+		with self.lock:
+			for light in lights:
+				self.fades.pop(light.UID(), None)
+
+	def fading(self):
+		"""
+		Return names of lights being faded
+		"""
+		with self.lock:
+			return [fade['light'].name() for fade in self.fades.values()]
+
+	def _loop(self):
+		while True:
+			with self.wakeup:
+				while not self.fades:
+					self.wakeup.wait()
+				states = self._step(time.monotonic())
+			if states:
+				self.bridge._apply_states(states, int(self.interval * 10), save=False)
+			with self.wakeup:
+				if self.fades:
+					self.wakeup.wait(self.interval)
+
+	def _step(self, now):
+		"""
+		Return dict from UIDs to (light, state, payload) for the next update of each fading
+		light, and remove fades which will be complete
+		"""
+		states = {}
+		for uid, fade in list(self.fades.items()):
+			# fraction of the fade complete by the next update
+			fraction = min(1.0, (now + self.interval - fade['start_time']) / fade['duration'])
+			if fraction >= 1.0:
+				del self.fades[uid]
+			setting = tuple(None if (a is None or b is None) else a + (b - a) * fraction
+				for (a, b) in zip(fade['start'], fade['end']))
+			rounded = tuple(None if x is None else int(round(x)) for x in setting)
+			if rounded == fade['last']:
+				continue
+			fade['last'] = rounded
+			light = fade['light']
+			try:
+				state = light._adjusted_state(bri=setting[0], kelvin=setting[1])
+				states[uid] = (light, state, light._compile_state(state))
+			except (TypeError, KeyError, ValueError):
+				logger.warning('No valid saved state for light %s' % (light.name()))
+				self.fades.pop(uid, None)
+		return states
 
 
 class Bridge():
 	"""
 	Implement a simplified API for a Philips Hue bridge and/or Osram Lightify Gateway.
 	Iterating over Bridge returns each _HueLight or _LightifyLight object
+	Commands to groups of lights are sent concurrently using a pool of worker threads for 
+	each protocol (`hue_workers`, `lightify_workers`), and commands to the Hue bridge are 
+	limited to `hue_rate` per second.
+	Requests to the Hue bridge share a pool of persistent HTTP connections, and time out
+	after `hue_timeout` seconds (retried up to `hue_retries` times).
+	Hue groups are created on the bridge for the sets of lights used in button groups and 
+	rules, and a command to all the Hue lights in one of these groups is sent as a single
+	group action.
+	The state of each light is cached, refreshed from the bridge and gateway in bulk at 
+	most every `state_interval` seconds when needed, and updated after each successful 
+	command.
+	With `fast_start`, the gateway addresses, Hue groups and light states saved in the file
+	config.BRIDGE_CACHE (default bridge_cache.json) on the previous run are used to 
+	construct the lights without any network requests.  These are then checked and refreshed in a background thread.
+	The Lightify Gateway is found by probing the addresses in `lightify_network` (CIDR).
+	Each light has its own lock, so commands to different lights run concurrently while
+	commands to the same light are serialised.  To avoid deadlock, locks are always 
+	acquired in this order: fade lock, scenes lock, light locks (in order of UID), pending lock, 
+	states lock, cache lock.  No lock is held while acquiring one earlier in the order.
+	Long fades between settings are run by a _FadeEngine, which updates each light at most
+	every `fade_interval` seconds.
+	Commands to each light are coalesced: if a later command for a light is issued before
+	an earlier one has been sent (e.g. while waiting for the light's lock or during the 
+	`command_debounce` period), only the later command is sent, and its result is 
+	returned to both callers.  Commands which only apply to lights that are on (setting
+	brightness, scenes and fades) don't supersede switching a light on or off, and 
+	whether a light is on is checked when the command is sent.
 	Documentation:
 		Lightify binary protocol - http://sarajarvi.org/lightify-haltuun/en.php
 		Philips Hue API - http://www.developers.meethue.com/philips-hue-api
 	"""
 
-	lock = threading.Lock()
+	def __init__(self, hue_uname=None, lightify=False, hue_workers=4, lightify_workers=4, hue_rate=10, hue_timeout=5, hue_retries=2, state_interval=60, fast_start=False,
+		lightify_network='192.168.1.0/27', command_debounce=0, fade_interval=10):
 
-	def __init__(self, hue_uname=None, lightify=False):
+		# worker threads to send commands to lights for each protocol
+		self._executors = {
+			_HueLight.PROTOCOL: concurrent.futures.ThreadPoolExecutor(hue_workers),
+			_LightifyLight.PROTOCOL: concurrent.futures.ThreadPoolExecutor(lightify_workers)
+		}
+		# limit rate of commands to the Hue bridge
+		self._rate_limiters = {_HueLight.PROTOCOL: _RateLimiter(hue_rate)}
 
 		self.__hue_connected = False
 		self.__lightify_connected = False
@@ -394,10 +708,35 @@ class Bridge():
 		# dict from light names to light objects
 		self.lights = {}
 		
-		if hue_uname != None: hue_IP = self._get_hue_address()
+		# HTTP client for Hue bridge, and dict from sets of Hue light IDs to Hue group IDs
+		self._hue = None
+		self._hue_groups = {}
+		self._lightify = None
+		self.lightify_network = lightify_network
+
+		# cache of current light states, keyed by UID, refreshed when due
+		self._states = {}
+		self._states_lock = threading.Lock()
+		self.state_interval = state_interval
+		self.refresh_states_due = time.monotonic()
+
+		# load addresses and states from previous run if starting quickly
+		self.fast_start = fast_start
+		self._cache_lock = threading.Lock()
+		cache = self._load_cache() if fast_start else None
+		saved_states = cache.get('saved_states', {}) if cache else {}
+
+		if hue_uname != None: 
+			hue_IP = (cache or {}).get('hue_address') or self._get_hue_address()
+			self._hue = _HueClient(hue_IP, hue_uname, timeout=hue_timeout, retries=hue_retries, pool_size=hue_workers)
 	
 		# connect to Osram Lightify gateway and load connected lights (if applicable)
-		if lightify: self._connect_to_lightify_gateway()				
+		if lightify:
+			if cache and cache.get('lightify_address'):
+				self._lightify = LightifyGateway(cache['lightify_address'])
+				self.__lightify_connected = True
+			else:
+				self._connect_to_lightify_gateway()				
 
 		# read list of connected lights from file if available, or connect to bridge and gateway to rebuild list
 		fname = config.SAVED_LIGHTS
@@ -412,7 +751,7 @@ class Bridge():
 			# connect to Philips Hue bridge and load connected lights (if applicable)
 			if hue_uname != None:
 				print('Connecting to Hue Bridge...')
-				self._connect_to_hue_bridge(hue_uname, hue_IP)
+				self._connect_to_hue_bridge(self._hue)
 		
 			# save list of lights to file
 			lights_to_save = []
@@ -435,11 +774,11 @@ class Bridge():
 			for l in saved_lights:
 				if l['type'] == 'Hue':
 					# create _HueLight object with name, ID and UID from file
-					self.lights[l['name']] = _HueLight(l['name'], l['id'], l['uid'], host=hue_IP, username=hue_uname)
+					self.lights[l['name']] = _HueLight(l['name'], l['id'], l['uid'], client=self._hue, state=saved_states.get(l['uid']))
 					self.__hue_connected = True
 					logger.info(self.lights[l['name']].name())
 				elif l['type'] == 'Lightify':
-					self.lights[l['name']] = _LightifyLight(l['addr'], self._lightify._host, name=l['name'], uid=l['uid'])				
+					self.lights[l['name']] = _LightifyLight(l['addr'], self._lightify._host, name=l['name'], uid=l['uid'], state=saved_states.get(l['uid']))				
 					self.__lightify_connected = True
 					logger.info(self.lights[l['name']].name())
 			print('OK')		
@@ -453,17 +792,100 @@ class Bridge():
 		except IOError:
 			print('No saved scenes found.')
 			self.__scenes = {}
+		self._scenes_lock = threading.Lock()
+		# dict from scene names to compiled scenes
+		self._scene_index = {name: self._compile_scene(scene) for name, scene in self.__scenes.items()}
+
+		# lock for each light, keyed by UID
+		self._light_locks = {light.UID(): threading.Lock() for light in self.lights.values()}
+
+		# futures for results of latest command and latest on/off command issued to each 
+		# light, keyed by UID
+		self._pending = {}
+		self._pending_switch = {}
+		self._pending_lock = threading.Lock()
+		self.command_debounce = command_debounce
+
+		# engine for fades longer than a single transition
+		self._fader = _FadeEngine(self, fade_interval)
+
+		if cache is not None:
+			# use cached states and Hue groups until checked in background
+			self._states.update(cache.get('states', {}))
+			self._hue_groups = {frozenset(ids): group_id for ids, group_id in cache.get('hue_groups', [])}
+			threading.Thread(target=self._validate, daemon=True).start()
+		else:
+			# create Hue groups for sets of lights switched together
+			if self.__hue_connected and (self._hue is not None):
+				self._hue_groups = self._sync_hue_groups(self._get_light_sets())
+			if fast_start:
+				self._save_cache()
 			
-	def _connect_to_hue_bridge(self, username, IP):
+	def _load_cache(self):
 		"""
-		Query hue bridge using given username and IP address to get list
-		of lights. Create a _HueLight object for each light, with names as keys
-		and append to lights dictionary.
+		Return addresses, Hue groups and light states saved by previous run, or None if not
+		available
+		"""
+		if not os.path.exists(config.SAVED_LIGHTS):
+			return None
+		try:
+			with open(_bridge_cache_path(), 'r') as f:
+				cache = json.load(f)
+		except (IOError, ValueError):
+			print('No bridge cache found, starting normally')
+			return None
+		logger.info('Starting from bridge cache')
+		return cache
+
+	def _save_cache(self):
+		"""
+		Save addresses, Hue groups and light states for fast start
+		"""
+		with self._states_lock:
+			states = dict(self._states)
+		cache = {
+			'hue_address': self._hue.host if self._hue is not None else None,
+			'lightify_address': self._lightify._host if self._lightify is not None else None,
+			'hue_groups': [[sorted(ids), group_id] for ids, group_id in self._hue_groups.items()],
+			'saved_states': {light.UID(): light.saved_state() for light in self.lights.values()},
+			'states': states
+		}
+		with self._cache_lock:
+			try:
+				with open(_bridge_cache_path(), 'w') as f:
+					json.dump(cache, f)
+			except IOError as err:
+				logger.warning('Could not save bridge cache (%s)' % (err))
+
+	def _validate(self):
+		"""
+		Check cached addresses after fast start by refreshing light states and Hue groups, 
+		and update cache.  If any light can't be reached, the cache is deleted so that the
+		next start rediscovers the bridge and gateway.
+		"""
+		states = self.refresh_states()
+		missing = [light.name() for light in self.lights.values() if light.UID() not in states]
+		if self.__hue_connected and (self._hue is not None):
+			self._hue_groups = self._sync_hue_groups(self._get_light_sets())
+		if missing:
+			logger.warning('Could not get state of lights %s, bridge cache may be out of date' % (missing))
+			with self._cache_lock:
+				try:
+					os.remove(_bridge_cache_path())
+				except OSError:
+					pass
+		else:
+			logger.info('Bridge cache validated')
+			self._save_cache()
+
+	def _connect_to_hue_bridge(self, client):
+		"""
+		Query hue bridge using given client to get list of lights. Create a _HueLight 
+		object for each light, with names as keys and append to lights dictionary.
 		"""
 		self.__hue_connected = True
 				
-		url = 'http://'+IP+'/api/'+username+'/lights'
-		r = requests.get(url)
+		r = client.get(client.base_url + '/lights', 'lights')
 		if r.status_code == 200:
 			print('Hue bridge ready')
 		else:
@@ -472,7 +894,7 @@ class Bridge():
 	
 		for light_id in r:
 			name = (r[light_id]['name'])
-			self.lights[name] = _HueLight(name,light_id, host=IP, username=username)
+			self.lights[name] = _HueLight(name,light_id, client=client, state=r[light_id].get('state'))
 			logger.debug(self.lights[name].name())
 
 	def _get_hue_address(self):
@@ -515,6 +937,9 @@ class Bridge():
 		self.__lightify_connected = True
 
 		self._lightify = self._get_lightify_gateway()
+		if self._lightify is None:
+			self.__lightify_connected = False
+			return
 		
 		for light in self._lightify.lights.values():
 			self.lights[light.name()] = light
@@ -522,60 +947,282 @@ class Bridge():
 	
 	def _get_lightify_gateway(self):
 		"""
-		Get Lightify Gateway by pinging IP addresses
+		Get Lightify Gateway by probing addresses on lightify_network
+		"""
+		gateways = find_lightify_gateways(self.lightify_network)
+		if len(gateways) == 0:
+			logger.error('Lightify Gateway not found!')
+			return None
+		if len(gateways) > 1:
+			logger.warning('Found %s Lightify Gateways, using %s' % (len(gateways), gateways[0]))
+		lightify = LightifyGateway(gateways[0])
+		lightify.get_all_lights()
+		logger.debug("Found Lightify Gateway at: {}".format(gateways[0]))
+		return(lightify)
+
+	def _get_light_sets(self):
 		"""
-		base_address = "192.168.1."
-		for i in range(32):
-			ip = base_address + str(i)
-			lightify = LightifyGateway(ip)
+		Return list of sets of light names used in Flic button groups and rules, including
+		the set of all lights
+		"""
+		light_sets = [set(self.lights)]
+		try:
+			with open(config.FLIC_BUTTONS, 'r') as f:
+				for button in json.load(f).values():
+					light_sets.append(set(button['group']))
+		except (AttributeError, IOError, ValueError, KeyError):
+			logger.debug('No Flic button groups found')
+		try:
+			with open(config.RULES, 'r') as f:
+				for rule in json.load(f):
+					if 'lights' in rule:
+						light_sets.append(set(rule['lights']) or set(self.lights))
+		except (AttributeError, IOError, ValueError, KeyError):
+			logger.debug('No rules found')
+		return light_sets
+
+	def _sync_hue_groups(self, light_sets):
+		"""
+		Find or create a group on the Hue bridge for the Hue lights in each set of light names
+		with more than one Hue light.  Return dict from sets of Hue light IDs to group IDs.
+		"""
+		wanted = set()
+		for names in light_sets:
+			ids = frozenset(self.lights[n].ID() for n in names if isinstance(self.lights.get(n), _HueLight))
+			if len(ids) > 1:
+				wanted.add(ids)
+		url = self._hue.base_url + '/groups'
+		groups = {}
+		try:
+			r = self._hue.get(url, 'groups')
+			r.raise_for_status()
+			for group_id, group in r.json().items():
+				groups[frozenset(group['lights'])] = group_id
+			for ids in wanted - set(groups):
+				name = ('jubilee ' + ','.join(sorted(ids, key=int)))[:32]
+				r = self._hue.post(url, 'groups', {'name': name, 'type': 'LightGroup', 'lights': sorted(ids, key=int)})
+				r.raise_for_status()
+				for rc in r.json():
+					if 'success' in rc:
+						groups[ids] = rc['success']['id']
+						logger.info('Created Hue group %s for lights %s' % (rc['success']['id'], sorted(ids, key=int)))
+					else:
+						logger.warning(rc)
+		except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+			logger.warning('Could not update Hue groups (%s)' % (err))
+		return {ids: group_id for ids, group_id in groups.items() if ids in wanted}
+
+	def _run_group_action(self, group_id, payload):
+		"""
+		Apply action to all lights in Hue group.  Return True if successful.
+		"""
+		try:
+			self._rate_limiters[_HueLight.PROTOCOL].wait()
+			logger.info('Sending action %s to Hue group %s' % (payload, group_id))
+			url = self._hue.base_url + '/groups/' + group_id + '/action'
+			r = self._hue.put(url, 'group action', payload)
+			return _check_hue_response(r)
+		except Exception:
+			logger.exception('Action failed for Hue group %s' % (group_id))
+			return False
+
+	def hue_latency(self):
+		"""
+		Return latency histograms for requests to each Hue bridge endpoint
+		"""
+		if self._hue is None:
+			return {}
+		return self._hue.latency_histograms()
+
+	def refresh_states(self):
+		"""
+		Fetch current states of all lights (one request each to the Hue bridge and Lightify
+		Gateway) and update cache.  Returns dict from UIDs to states fetched.
+		"""
+		self.refresh_states_due = time.monotonic() + self.state_interval
+		states = {}
+		if self._hue is not None:
+			hue_lights = {l.ID(): l for l in self.lights.values() if isinstance(l, _HueLight)}
+			if hue_lights:
+				try:
+					r = self._hue.get(self._hue.base_url + '/lights', 'lights')
+					r.raise_for_status()
+					for light_id, light in r.json().items():
+						if light_id in hue_lights:
+							states[hue_lights[light_id].UID()] = light['state']
+				except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+					logger.warning('Could not get Hue light states (%s)' % (err))
+		if self._lightify is not None:
+			lightify_lights = {l.addr(): l for l in self.lights.values() if isinstance(l, _LightifyLight)}
+			if lightify_lights:
+				try:
+					for addr, state in self._lightify.get_all_light_states().items():
+						if addr in lightify_lights:
+							states[lightify_lights[addr].UID()] = state
+				except (OSError, RuntimeError, struct.error) as err:
+					logger.warning('Could not get Lightify light states (%s)' % (err))
+		with self._states_lock:
+			self._states.update(states)
+		logger.debug('Refreshed states of %s lights' % (len(states)))
+		return states
+
+	def light_states(self, named_lights=[]):
+		"""
+		Return dict from light names to cached states (None if not known), using the same 
+		arguments as light_on()
+		"""
+		lights = self._get_lights(named_lights)
+		self._refresh_states_if_due()
+		with self._states_lock:
+			return {light.name(): self._states.get(light.UID()) for light in lights}
+
+	def _refresh_states_if_due(self):
+		if time.monotonic() > self.refresh_states_due:
+			self.refresh_states()
+
+	def _compile_scene(self, scene):
+		"""
+		Return dict from UIDs to (light, state, payload) for each light in scene, where 
+		payload is the light's precompiled command to recall the state
+		"""
+		lights = {light.UID(): light for light in self.lights.values()}
+		compiled = {}
+		for UID, state in scene.items():
+			light = lights.get(UID)
+			if light is None:
+				continue
 			try:
-				lightify.get_all_lights()
-			except:
-				pass
-			else:
-				logger.debug("Found Lightify Gateway at: {}".format(ip))
-				return(lightify)
+				compiled[UID] = (light, state, light._compile_state(state))
+			except (TypeError, KeyError, ValueError, struct.error):
+				logger.warning('Invalid saved state for light %s: %s' % (light.name(), state))
+		return compiled
+
+	def _cached_state(self, light):
+		with self._states_lock:
+			return self._states.get(light.UID()) or {}
 
-	@sync(lock)
 	def save_scene_locally(self, scene_name):
 		"""
 		Save current lights settings as a new scene with a supplied name (must be unique)
 		"""
 		# save states of all lights
+		self.refresh_states()
 		scene = {}
-		# save states of all lights
 		for light in self.lights.values():
-			scene[light.UID()] = light.save_state()
-		self.__scenes[scene_name] = scene
-		with open(config.SAVED_SCENES, 'w') as f:
-			json.dump(self.__scenes, f, indent=4)
+			state = self._cached_state(light)
+			if state:
+				scene[light.UID()] = state
+		compiled = self._compile_scene(scene)
+		with self._scenes_lock:
+			self.__scenes[scene_name] = scene
+			self._scene_index[scene_name] = compiled
+			with open(config.SAVED_SCENES, 'w') as f:
+				json.dump(self.__scenes, f, indent=4)
 		print('Saved scene: ' + scene_name)
 	
-	@sync(lock)
 	def recall_local_scene(self, scene_name, transition=4):
 		"""
-		Recall saved light settings
+		Recall saved light settings (threadsafe)
 		"""
 
-		# load light states corresponding to named scene
-		try:
-			scene = self.__scenes[scene_name]
-		except (KeyError, OSError):
+		# load compiled light states corresponding to named scene
+		with self._scenes_lock:
+			scene = self._scene_index.get(scene_name)
+		if scene is None:
 			logger.error('Scene not found: ' + scene_name)
 			return
 
-		# find saved state for each light in scene, update locally saved settings,
-		# and push new settings to light if currently switched on
-		for light in self.lights.values():
-			for UID, light_state in scene.items():
-				if UID == light.UID():
-					if light.save_state()['on']:
-						light._recall_state(light_state, transition=transition)
-					light.update_state(light_state)
-		
+		self._fader.cancel([light for (light, state, payload) in scene.values()])
+		self._apply_states(scene, transition)
 		logger.info('Recalled scene: ' + scene_name)
 
-	@sync(lock)
+	def light_set(self, named_lights, bri=None, kelvin=None, transition=4):
+		"""
+		Set brightness and/or colour temperature of named light or lights (threadsafe).  The
+		saved settings of each light are updated, and pushed to lights which are switched on.
+
+		@param named_lights light or lights, as for light_on()
+		@param bri brightness in percent
+		@param kelvin colour temperature in kelvin
+		@return dict from names of lights which are on to True if set successfully, False otherwise
+		"""
+		states = {}
+		lights = self._get_lights(named_lights)
+		self._fader.cancel(lights)
+		for light in lights:
+			try:
+				state = light._adjusted_state(bri=bri, kelvin=kelvin)
+				states[light.UID()] = (light, state, light._compile_state(state))
+			except (TypeError, KeyError, ValueError):
+				logger.warning('No valid saved state for light %s' % (light.name()))
+		return self._apply_states(states, transition)
+
+	def fade_to_scene(self, scene_name, duration, named_lights=[], from_scene=None):
+		"""
+		Fade brightness and colour temperature of lights from their current settings (or the
+		settings in from_scene) to the settings in a saved scene (threadsafe).  Returns
+		immediately; the fade continues in the background, and is stopped for a light by
+		light_set(), recall_local_scene() or another fade.  Lights which are switched off
+		have their saved settings updated, so they switch on at the current point in the fade.
+
+		@param scene_name name of saved scene to fade to
+		@param duration length of fade in seconds
+		@param named_lights light or lights, as for light_on() (default: all lights in scene)
+		@param from_scene name of saved scene to start from (default: current settings)
+		@return list of names of lights being faded
+		"""
+		with self._scenes_lock:
+			scene = self._scene_index.get(scene_name)
+			start_scene = self._scene_index.get(from_scene) if from_scene is not None else None
+		if scene is None or (from_scene is not None and start_scene is None):
+			logger.error('Scene not found: %s' % (scene_name if scene is None else from_scene))
+			return []
+		lights = self._get_lights(named_lights) if named_lights else [light for (light, state, payload) in scene.values()]
+		self._refresh_states_if_due()
+		fades = []
+		for light in lights:
+			if light.UID() not in scene:
+				continue
+			try:
+				if start_scene is not None:
+					start = light._setting(start_scene[light.UID()][1])
+				else:
+					try:
+						start = light._setting(self._cached_state(light))
+					except (TypeError, KeyError, ValueError):
+						start = light._setting(light.saved_state())
+				fades.append((light, start, light._setting(scene[light.UID()][1])))
+			except (TypeError, KeyError, ValueError):
+				logger.warning('No valid saved state for light %s' % (light.name()))
+		self._fader.start(fades, duration)
+		logger.info('Fading to scene %s over %s seconds' % (scene_name, duration))
+		return [light.name() for (light, start, end) in fades]
+
+	def cancel_fade(self, named_lights=[]):
+		"""
+		Stop fading named light or lights at their current settings (threadsafe)
+		"""
+		self._fader.cancel(self._get_lights(named_lights))
+
+	def _apply_states(self, states, transition, save=True):
+		"""
+		Update locally saved settings of lights from dict of UIDs to (light, state, payload),
+		and push precompiled payloads to lights which are currently switched on.  Lightify
+		commands to lights on the same gateway are pipelined together.
+		"""
+		self._refresh_states_if_due()
+		lights = [light for (light, state, payload) in states.values()]
+		with self._locked(lights):
+			for (light, state, payload) in states.values():
+				light.update_state(state)
+		results = self._send(lights, lambda light: light._send_payload(states[light.UID()][2], transition=transition),
+			hue_payload=lambda light: dict(states[light.UID()][2], transitiontime=transition),
+			lightify_commands=lambda light: light._payload_commands(states[light.UID()][2], transition=transition),
+			new_state=lambda light: dict(states[light.UID()][1], on=True), only_on=True)
+		if self.fast_start and save:
+			self._save_cache()
+		return results
+
 	def light_on(self, named_lights, transition=4):
 		"""
 		Switch on named light or lights (threadsafe)
@@ -584,19 +1231,11 @@ class Bridge():
 			Supply light name as string to switch one light.  
 			Supply a list or tuple of light names to switch a group
 			Supply empty list or tuple to switch all lights
+		@return dict from light names to True if switched successfully, False otherwise
 		"""
-		if isinstance(named_lights, (list, tuple)):
-			if len(named_lights) == 0:
-				named_lights = self.lights
-		elif isinstance(named_lights, (str)):
-			named_lights = [named_lights]
-		else:
-			raise TypeError('Invalid light name')
-					
-		for light in named_lights:
-			self.lights[light].on(transition)						
+		return self._send(self._get_lights(named_lights), lambda light: light.on(transition),
+			hue_payload=lambda light: light._on_payload(transition), new_state=lambda light: light._new_state(True))
 	
-	@sync(lock)
 	def light_off(self, named_lights, transition=4):
 		"""
 		Switch off named light or lights (threadsafe)
@@ -605,6 +1244,69 @@ class Bridge():
 			Supply light name as string to switch one light.  
 			Supply a list or tuple of light names to switch a group
 			Supply empty list or tuple to switch all lights
+		@return dict from light names to True if switched successfully, False otherwise
+		"""
+		return self._send(self._get_lights(named_lights), lambda light: light.off(transition),
+			hue_payload=lambda light: light._off_payload(transition), new_state=lambda light: light._new_state(False))
+
+	def _send(self, lights, command, hue_payload=None, lightify_commands=None, new_state=None, only_on=False):
+		"""
+		Send command to lights using _dispatch(), holding the lights' locks.  Lights for 
+		which a later command is issued before this one is sent are skipped, and the result
+		of the later command is returned for them.  Returns dict from light names to results.
+		With only_on, the command is only sent to lights which are on when it is sent 
+		(others are left out of the results), and it doesn't supersede earlier on/off 
+		commands.
+		"""
+		# register as latest command for each light
+		futures = {}
+		pending = self._pending if only_on else self._pending_switch
+		with self._pending_lock:
+			for light in lights:
+				futures[light.UID()] = self._pending[light.UID()] = concurrent.futures.Future()
+				if not only_on:
+					self._pending_switch[light.UID()] = futures[light.UID()]
+		if self.command_debounce > 0:
+			time.sleep(self.command_debounce)
+		with self._locked(lights):
+			# find lights for which this is still the latest command
+			with self._pending_lock:
+				newer = {light.UID(): pending[light.UID()] for light in lights if pending[light.UID()] is not futures[light.UID()]}
+			current = [light for light in lights if light.UID() not in newer]
+			if only_on:
+				# earlier commands have been sent, so the cached states are up to date
+				for light in current:
+					if not self._cached_state(light).get('on'):
+						futures[light.UID()].set_result(True)
+				current = [light for light in current if not futures[light.UID()].done()]
+			results = self._dispatch(current, command, hue_payload=hue_payload, lightify_commands=lightify_commands, new_state=new_state)
+			for light in current:
+				futures[light.UID()].set_result(results[light.name()])
+		# wait for results of commands which superseded this one (after releasing locks)
+		for light in lights:
+			if light.UID() in newer:
+				logger.debug('Command to light %s superseded' % (light.name()))
+				results[light.name()] = newer[light.UID()].result()
+				futures[light.UID()].set_result(results[light.name()])
+		return results
+
+	@contextlib.contextmanager
+	def _locked(self, lights):
+		"""
+		Hold locks for lights, acquired in order of UID
+		"""
+		locks = [self._light_locks[uid] for uid in sorted(set(light.UID() for light in lights))]
+		for lock in locks:
+			lock.acquire()
+		try:
+			yield
+		finally:
+			for lock in reversed(locks):
+				lock.release()
+
+	def _get_lights(self, named_lights):
+		"""
+		Return list of light objects for light name, list of names or empty list (all lights)
 		"""
 		if isinstance(named_lights, (list, tuple)):
 			if len(named_lights) == 0:
@@ -613,9 +1315,164 @@ class Bridge():
 			named_lights = [named_lights]
 		else:
 			raise TypeError('Invalid light name')
-		
-		for light in named_lights:
-			self.lights[light].off(transition)
+		return [self.lights[light] for light in named_lights]
+
+	def _dispatch(self, lights, command, hue_payload=None, lightify_commands=None, new_state=None):
+		"""
+		Call command(light) for each light concurrently on the worker threads for each 
+		light's protocol, and wait for all to complete.  Returns dict from light names to
+		results (False if the command raised an exception).
+		If the Hue lights match a Hue group and hue_payload(light) returns the same payload
+		for all of them, the payload is sent to the group instead.
+		If supplied, the lists of commands lightify_commands(light) for Lightify lights on the
+		same gateway are pipelined in one batch instead.
+		If supplied, new_state(light) is merged into the cached state of each light for 
+		which the command succeeded.
+		"""
+		by_name = {light.name(): light for light in lights}
+		futures = {}
+		if hue_payload is not None:
+			hue_lights = [l for l in lights if isinstance(l, _HueLight)]
+			group_id = self._hue_groups.get(frozenset(l.ID() for l in hue_lights))
+			try:
+				payloads = [hue_payload(l) for l in hue_lights] if group_id is not None else []
+			except (TypeError, KeyError):
+				# no valid saved state for a light, so send commands to lights separately
+				payloads = []
+			if len(payloads) > 0:
+				if all(p == payloads[0] for p in payloads):
+					f = self._executors[_HueLight.PROTOCOL].submit(self._run_group_action, group_id, payloads[0])
+					for light in hue_lights:
+						futures[light.name()] = f
+					lights = [l for l in lights if not isinstance(l, _HueLight)]
+		if lightify_commands is not None:
+			gateways = {}
+			for light in lights:
+				if isinstance(light, _LightifyLight):
+					gateways.setdefault((light._host, light._port), []).append(light)
+			for batch in gateways.values():
+				if len(batch) > 1:
+					f = self._executors[_LightifyLight.PROTOCOL].submit(self._run_lightify_batch, batch, lightify_commands)
+					for light in batch:
+						futures[light.name()] = f
+			lights = [l for l in lights if l.name() not in futures]
+		for light in lights:
+			futures[light.name()] = self._executors[light.PROTOCOL].submit(self._run_command, light, command)
+		results = {}
+		for name, f in futures.items():
+			result = f.result()
+			# batches return dict from light names to results
+			results[name] = result[name] if isinstance(result, dict) else result
+		if new_state is not None:
+			self._update_states([by_name[name] for name, ok in results.items() if ok], new_state)
+		return results
+
+	def _update_states(self, lights, new_state):
+		# optimistically update cached states after successful commands
+		with self._states_lock:
+			for light in lights:
+				try:
+					state = new_state(light)
+				except (TypeError, KeyError, ValueError):
+					continue
+				self._states[light.UID()] = dict(self._states.get(light.UID()) or {}, **state)
+
+	def _run_command(self, light, command):
+		try:
+			limiter = self._rate_limiters.get(light.PROTOCOL)
+			if limiter is not None:
+				limiter.wait()
+			return command(light)
+		except Exception:
+			logger.exception('Command failed for light %s' % (light.name()))
+			return False
+
+	def _run_lightify_batch(self, lights, lightify_commands):
+		"""
+		Send lists of commands to Lightify lights on the same gateway, pipelined in one 
+		round trip.  Returns dict from light names to results.
+		"""
+		try:
+			commands = [lightify_commands(light) for light in lights]
+			responses = lights[0]._send_commands([c for light_commands in commands for c in light_commands])
+			results = {}
+			for light, light_commands in zip(lights, commands):
+				(light_responses, responses) = (responses[:len(light_commands)], responses[len(light_commands):])
+				results[light.name()] = all([light._check_rc(r) for r in light_responses])
+			return results
+		except Exception:
+			logger.exception('Commands failed for Lightify lights %s' % ([light.name() for light in lights]))
+			return {light.name(): False for light in lights}
+
+
+class _Histogram():
+	"""
+	Count of latencies in buckets (upper bounds in seconds)
+	"""
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+	def __init__(self):
+		self.counts = [0] * len(self.BUCKETS)
+		self.total = 0.0
+
+	def record(self, value):
+		for i, bound in enumerate(self.BUCKETS):
+			if value <= bound:
+				self.counts[i] += 1
+				break
+		self.total += value
+
+	def summary(self):
+		count = sum(self.counts)
+		return {
+			'count': count,
+			'mean': self.total / count if count else 0.0,
+			'buckets': {str(bound): n for bound, n in zip(self.BUCKETS, self.counts)}
+		}
+
+
+class _HueClient():
+	"""
+	HTTP client for a Hue bridge, shared by all lights on the bridge.  Uses a pool of 
+	persistent connections, with a timeout and retries with backoff on each request, and 
+	records a latency histogram for each endpoint.
+	"""
+	def __init__(self, host, username, timeout=5, retries=2, backoff=0.2, pool_size=4):
+		self.host = host
+		self.base_url = 'http://'+host+'/api/'+username
+		self.timeout = timeout
+		# retry idempotent requests only
+		retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+			allowed_methods=frozenset(['GET', 'PUT']))
+		self.session = requests.Session()
+		self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+		# dict from endpoint names to latency histograms
+		self.latency = {}
+		self.lock = threading.Lock()
+
+	def get(self, url, endpoint):
+		return self._request('GET', url, endpoint)
+
+	def put(self, url, endpoint, payload):
+		return self._request('PUT', url, endpoint, json=payload)
+
+	def post(self, url, endpoint, payload):
+		return self._request('POST', url, endpoint, json=payload)
+
+	def latency_histograms(self):
+		"""
+		Return summary of latency histogram for each endpoint
+		"""
+		with self.lock:
+			return {endpoint: h.summary() for endpoint, h in self.latency.items()}
+
+	def _request(self, method, url, endpoint, **kwargs):
+		start = time.monotonic()
+		try:
+			return self.session.request(method, url, timeout=self.timeout, **kwargs)
+		finally:
+			with self.lock:
+				self.latency.setdefault(endpoint, _Histogram()).record(time.monotonic() - start)
 
 
 class _HueLight():
@@ -625,21 +1482,30 @@ class _HueLight():
 	calls to methods on Bridge objects only preferred to enable implementation of thread 
 	safety.)
 	"""
+
+	PROTOCOL = 'Hue'
 	
-	def __init__(self, name, ID, UID=None, host=None, username=None):
-		# IP address for bridge and username
-		self._IP = host
-		self._username = username
+	def __init__(self, name, ID, UID=None, host=None, username=None, client=None, state=None):
+		# HTTP client for bridge (shared with other lights if supplied)
+		if client is None:
+			client = _HueClient(host, username)
+		self._client = client
+		self._IP = client.host
 		# name as stored in Hue bridge
 		self.__name = name
 		# light ID as stored in Hue bridge
 		self.__ID = ID
+		self._url = client.base_url + '/lights/' + str(ID)
+		self._state_url = self._url + '/state'
 		# unique ID used to identify light in scenes (avoids problems if names are duplicated across Lightify gateway and Hue bridge)
 		if UID == None:
 			self.__UID = uid_module.get_UID()
 		else:
 			self.__UID = UID
-		self.__state = self.save_state()
+		# settings applied when switched on (fetched from bridge if not supplied)
+		if state is None:
+			state = self.save_state()
+		self.__state = state
 
 	def UID(self):
 		return self.__UID
@@ -659,32 +1525,51 @@ class _HueLight():
 		"""
 		if transition == False: transition = 4
 		logger.info('Switching light %s on with saved settings' % (self.name()))
-		self._recall_state(self.__state, transition=transition)
+		return self._recall_state(self.__state, transition=transition)
 
 	def off(self, transition=4):
 		"""
 		Switches the light off
 		"""
 		if transition == False: transition = 4		
-		self._on_or_off('off', transition)
+		return self._on_or_off('off', transition)
 		
 	def _on_or_off(self, operation, transition):
 		logger.info('Switching light %s %s' % (self.name(), operation))
-		url = 'http://'+self._IP+'/api/'+self._username+'/lights/'+self.__ID+'/state'
 		if operation == 'on':
 			payload = {"on": True, "transitiontime":transition}
 		else:
-			payload = {"on": False, "transitiontime":transition}
-		r = requests.put(url, json=payload)
-		self._check_rc(r)
+			payload = self._off_payload(transition)
+		r = self._client.put(self._state_url, 'light state', payload)
+		return self._check_rc(r)
+
+	def _off_payload(self, transition=4):
+		"""
+		Return payload to switch light off
+		"""
+		return {"on": False, "transitiontime":transition}
+
+	def _on_payload(self, transition=4):
+		"""
+		Return payload to switch light on with previously saved settings
+		"""
+		if transition == False: transition = 4
+		return self._state_payload(self.__state, transition)
+
+	def _new_state(self, on):
+		"""
+		Return expected state after switching light on with saved settings, or off
+		"""
+		if on:
+			return dict(self.__state, on=True)
+		return {'on': False}
 			
 	def save_state(self):
 		"""
 		Fetch current state of light from bridge and save
 		"""
 		logger.info('Getting current state of light %s' % (self.name()))		
-		url = 'http://'+self._IP+'/api/'+self._username+'/lights/'+str(self.__ID)
-		r = requests.get(url)
+		r = self._client.get(self._url, 'light')
 		try:
 			r.raise_for_status()
 		except requests.exceptions.HTTPError:
@@ -698,7 +1583,46 @@ class _HueLight():
 		"""
 		Switch light on with previously saved parameters (brightness, colour temperature/colour & on/off only)
 		"""
-		url = 'http://'+self._IP+'/api/'+self._username+'/lights/'+self.__ID+'/state'
+		return self._send_payload(self._compile_state(state), transition)
+
+	def _send_payload(self, payload, transition=4):
+		"""
+		Send payload from _compile_state() with transition time
+		"""
+		r = self._client.put(self._state_url, 'light state', dict(payload, transitiontime=transition))
+		return self._check_rc(r)
+
+	def _state_payload(self, state, transition=4):
+		"""
+		Return payload to switch light on with saved parameters
+		"""
+		return dict(self._compile_state(state), transitiontime=transition)
+
+	def _adjusted_state(self, bri=None, kelvin=None):
+		"""
+		Return saved state with brightness (percent) and/or colour temperature (kelvin) replaced
+		"""
+		state = dict(self.__state)
+		if bri is not None:
+			state['bri'] = max(1, min(254, int(round(bri * 254 / 100))))
+		if kelvin is not None and 'ct' in state:
+			# colour temperature in mireds
+			state['ct'] = max(153, min(500, int(round(1e6 / kelvin))))
+			state['colormode'] = 'ct'
+		return state
+
+	def _setting(self, state):
+		"""
+		Return (brightness in percent, colour temperature in kelvin or None) of state
+		"""
+		kelvin = 1e6 / state['ct'] if state.get('colormode', 'ct') == 'ct' and 'ct' in state else None
+		return (state['bri'] * 100 / 254, kelvin)
+
+	def _compile_state(self, state):
+		"""
+		Return payload to switch light on with saved parameters, without transition time
+		"""
+		color_command = {}
 		try:
 			if state['colormode'] == 'hs':
 				# set hue & saturation
@@ -711,28 +1635,44 @@ class _HueLight():
 				color_command = {"ct": state['ct']}
 		except KeyError:
 			# light doesn't support setting colour
-			color_command = ''
+			color_command = {}
 
-		payload = {"on":True,"bri":state['bri'],"transitiontime":transition}
+		payload = {"on":True,"bri":state['bri']}
 		payload.update(color_command)
-		r = requests.put(url, json=payload)
-		self._check_rc(r)
+		return payload
 
 	def update_state(self, state):
 		# update saved parameters
 		self.__state = state
+
+	def saved_state(self):
+		"""
+		Return settings applied when light is switched on
+		"""
+		return self.__state
 		
 	def _check_rc(self, r):
-		try:
-			r.raise_for_status()
-		except requests.exceptions.HTTPError:
-			logger.warning('HTTP status: %s (%s)' % (r.text))
-		else:
-			for rc in r.json():
-				if 'success' in rc:
-					logger.debug(rc)
-				else:
-					logger.warning(rc)
+		return _check_hue_response(r)
+
+
+def _check_hue_response(r):
+	"""
+	Log response from Hue bridge and return True if all commands were successful
+	"""
+	try:
+		r.raise_for_status()
+	except requests.exceptions.HTTPError:
+		logger.warning('HTTP status: %s (%s)' % (r.status_code, r.text))
+		return False
+	else:
+		success = True
+		for rc in r.json():
+			if 'success' in rc:
+				logger.debug(rc)
+			else:
+				logger.warning(rc)
+				success = False
+		return success
 
 # binary commands for Lightify protocol
 COMMAND_ALL_LIGHT_STATUS = 0x13
@@ -743,46 +1683,221 @@ COMMAND_LIGHT_STATUS = 0x68
 
 LIGHTIFY_PORT = 4000
 
-class _Lightify():
+# light record in response to COMMAND_ALL_LIGHT_STATUS, and status field within record
+LIGHT_STATUS_RECORD = struct.Struct("<HQ16s16sQ")
+LIGHT_STATUS = struct.Struct("<Q?BH4B")
+
+def _parse_all_light_status(data):
 	"""
-	Base class with methods for communicating with Lightify Gateway
+	Return list of (addr, name, state) for each light in response to 
+	COMMAND_ALL_LIGHT_STATUS.  Raises ValueError if response is not valid.
 	"""
-	def __init__(self, host, port=LIGHTIFY_PORT):
+	if len(data) < 9 or data[1] != COMMAND_ALL_LIGHT_STATUS:
+		raise ValueError('Invalid response to light status command')
+	# get number of lights
+	(num,) = struct.unpack("<H", data[7:9])
+	logger.debug('num: %s' % (num))
+	end = 9 + num * LIGHT_STATUS_RECORD.size
+	if len(data) < end:
+		raise ValueError('Light status response truncated (%s lights, %s bytes)' % (num, len(data)))
+	# parse status info for each light from response
+	return [_parse_light_status(record) for record in LIGHT_STATUS_RECORD.iter_unpack(data[9:end])]
+
+def _parse_light_status(record):
+	"""
+	Return (addr, name, state) from light record unpacked from COMMAND_ALL_LIGHT_STATUS 
+	response
+	"""
+	(a, addr, stat, name, extra) = record
+	(b, on, bri, temp, red, green, blue, h) = LIGHT_STATUS.unpack(stat)
+	# Decode using cp437 for python3.
+	name = name.decode('cp437').replace('\0', "")
+	return (addr, name, {'on': int(on), 'bri': bri, 'temp': temp})
+
+class _LightifyConnection():
+	"""
+	Persistent connection to a Lightify Gateway, shared by all objects using the Gateway.
+	Each command is given a sequence number (bytes 4-7 of the header) which the Gateway 
+	echoes in its response, so commands from several threads can be in flight at once.
+	A reader thread matches responses to requests.  The connection is re-opened when 
+	it breaks.
+	"""
+	# registry of open connections, keyed by (host, port)
+	_connections = {}
+	_connections_lock = threading.Lock()
+
+	SEQUENCE = struct.Struct("<I")
+	LENGTH = struct.Struct("<H")
+
+	@classmethod
+	def get(cls, host, port=LIGHTIFY_PORT):
+		"""
+		Return the shared connection to the Gateway at (host, port)
+		"""
+		with cls._connections_lock:
+			connection = cls._connections.get((host, port))
+			if connection is None:
+				connection = cls(host, port)
+				cls._connections[(host, port)] = connection
+			return connection
+
+	def __init__(self, host, port=LIGHTIFY_PORT, timeout=5):
 		self._host = host
-		self._port = port		
-	
-	def _send_command(self, command):
-		# create and connect a new socket, send command and receive response
-		logger.debug('sending %s (%s bytes)' % (binascii.hexlify(command), len(command)))
-		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-			s.connect((self._host, self._port))
-			s.sendall(command)
-			response = self._recv(s)
-		return response
+		self._port = port
+		self.timeout = timeout
+		self._lock = threading.Lock()
+		self._sock = None
+		self._seq = 0
+		# requests awaiting responses, from sequence number to [event, response]
+		self._pending = collections.OrderedDict()
 
-	def _recv(self, s):
+	def request(self, command):
+		"""
+		Send command and return response
+		"""
+		return self.request_many([command])[0]
+
+	def request_many(self, commands):
+		"""
+		Send commands in one write and return list of responses, in the same order
+		"""
+		try:
+			return self._request_many(commands)
+		except OSError as e:
+			# connection may have been closed by the Gateway while idle, so try once more
+			logger.debug('Lightify connection to %s failed (%s), reconnecting' % (self._host, e))
+			return self._request_many(commands)
+
+	def close(self):
+		with self._lock:
+			self._disconnect(ConnectionError('connection closed'))
+
+	def _request_many(self, commands):
+		waiters = []
+		with self._lock:
+			if self._sock is None:
+				self._connect()
+			data = bytearray()
+			for command in commands:
+				self._seq = (self._seq + 1) & 0xffffffff
+				waiter = [threading.Event(), None]
+				self._pending[self._seq] = waiter
+				waiters.append(waiter)
+				data += command[:4] + self.SEQUENCE.pack(self._seq) + command[8:]
+			logger.debug('sending %s (%s bytes)' % (binascii.hexlify(data), len(data)))
+			try:
+				self._sock.sendall(data)
+			except OSError as e:
+				self._disconnect(e)
+				raise
+		responses = []
+		for waiter in waiters:
+			if not waiter[0].wait(self.timeout):
+				# drop connection, as later responses can't be trusted
+				with self._lock:
+					self._disconnect(socket.timeout('no response from Lightify Gateway'))
+			response = waiter[1]
+			if isinstance(response, Exception):
+				raise response
+			responses.append(response)
+		return responses
+
+	def _connect(self):
+		# called with lock held
+		logger.debug('Connecting to Lightify Gateway at %s:%s' % (self._host, self._port))
+		sock = socket.create_connection((self._host, self._port), timeout=self.timeout)
+		sock.settimeout(None)
+		self._sock = sock
+		threading.Thread(target=self._reader, args=(sock,), daemon=True).start()
+
+	def _disconnect(self, error):
+		# called with lock held; fail outstanding requests and close socket (shutting it 
+		# down first, as closing doesn't wake a reader blocked in recv)
+		if self._sock is not None:
+			try:
+				self._sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			try:
+				self._sock.close()
+			except OSError:
+				pass
+			self._sock = None
+		for waiter in self._pending.values():
+			waiter[1] = error
+			waiter[0].set()
+		self._pending.clear()
+
+	def _reader(self, sock):
+		# receive responses and pass each to the request with matching sequence number
+		try:
+			while True:
+				data = self._recv(sock)
+				(seq,) = self.SEQUENCE.unpack_from(data, 2)
+				with self._lock:
+					if self._sock is not sock:
+						# connection replaced; pending requests belong to the new one
+						return
+					waiter = self._pending.pop(seq, None)
+					if waiter is None and self._pending:
+						# Gateway didn't echo sequence number; responses arrive in order
+						(_, waiter) = self._pending.popitem(last=False)
+				if waiter is None:
+					logger.debug('Unexpected response from Lightify Gateway: %s' % (binascii.hexlify(data)))
+					continue
+				waiter[1] = data
+				waiter[0].set()
+		except (OSError, RuntimeError, struct.error) as e:
+			with self._lock:
+				if self._sock is sock:
+					logger.debug('Lightify connection to %s closed (%s)' % (self._host, e))
+					self._disconnect(ConnectionError('connection to Lightify Gateway lost'))
+
+	@classmethod
+	def _recv(cls, s):
 		# receive response from gateway
-		lengthsize = 2
-		data = s.recv(lengthsize)
-		(length,) = struct.unpack("<H", data[:lengthsize])
+		data = cls._recv_exactly(s, cls.LENGTH.size)
+		(length,) = cls.LENGTH.unpack(data)
+		data = cls._recv_exactly(s, length)
+		logger.debug('received "%s" (%s bytes)' % (binascii.hexlify(data), len(data)))
+		return data
+
+	@staticmethod
+	def _recv_exactly(s, expected):
 		chunks = []
-		expected = length + 2 - len(data)
 		while expected > 0:
 			chunk = s.recv(expected)
 			if chunk == b'':
 				raise RuntimeError('socket connection broken')
 			chunks.append(chunk)
 			expected = expected - len(chunk)
-		data = b''.join(chunks)
-		logger.debug('received "%s" (%s bytes)' % (binascii.hexlify(data), len(data)))
-		return data
+		return b''.join(chunks)
+
+class _Lightify():
+	"""
+	Base class with methods for communicating with Lightify Gateway
+	"""
+	def __init__(self, host, port=LIGHTIFY_PORT):
+		self._host = host
+		self._port = port		
+	
+	def _send_command(self, command):
+		# send command over shared connection to Gateway and receive response
+		return _LightifyConnection.get(self._host, self._port).request(command)
+
+	def _send_commands(self, commands):
+		# pipeline commands over shared connection to Gateway and receive responses
+		return _LightifyConnection.get(self._host, self._port).request_many(commands)
 	
 class _LightifyLight(_Lightify):
 	"""
 	Implement an API for an Osram Lightify light (on/off, save & recall state).
 	This object communicates with lights via a Lightify Gateway, using a binary protocol.
 	"""			
-	def __init__(self, addr, host, name=None, port=LIGHTIFY_PORT, uid=None):
+
+	PROTOCOL = 'Lightify'
+
+	def __init__(self, addr, host, name=None, port=LIGHTIFY_PORT, uid=None, state=None):
 		super(_LightifyLight, self).__init__(host, port)		
 		self._addr = addr
 		self._name = name
@@ -791,7 +1906,10 @@ class _LightifyLight(_Lightify):
 			self._UID = uid_module.get_UID()
 		else:
 			self._UID = uid
-		self._state = self.save_state()
+		# settings applied when switched on (fetched from gateway if not supplied)
+		if state is None:
+			state = self.save_state()
+		self._state = state
 
 	def UID(self):
 		"""
@@ -817,7 +1935,7 @@ class _LightifyLight(_Lightify):
 		"""
 		if transition == False: transition = 10
 		logger.info('Switching light %s on' % (self.name()))
-		self._recall_state(self._state, transition=transition)
+		return self._recall_state(self._state, transition=transition)
 		
 	def off(self, transition=10):
 		"""
@@ -825,7 +1943,7 @@ class _LightifyLight(_Lightify):
 		"""
 		if transition == False: transition = 10
 		logger.info('Switching light %s off' % (self.name()))		
-		self.set_bri(0, transition=transition)
+		return self.set_bri(0, transition=transition)
 
 	def save_state(self):		
 		"""
@@ -851,9 +1969,48 @@ class _LightifyLight(_Lightify):
 		Switch on light to previously saved state
 		"""
 		logger.info('Recalling state: %s' % (state))
-		# recall saved brightness & colour temperature
-		self.set_bri(state['bri'], transition=transition)
-		self.set_temp(state['temp'], transition=transition)
+		return self._send_payload(self._compile_state(state), transition=transition)
+
+	def _adjusted_state(self, bri=None, kelvin=None):
+		"""
+		Return saved state with brightness (percent) and/or colour temperature (kelvin) replaced
+		"""
+		state = dict(self._state)
+		if bri is not None:
+			state['bri'] = max(0, min(100, int(round(bri))))
+		if kelvin is not None:
+			state['temp'] = max(2700, min(6500, int(round(kelvin))))
+		return state
+
+	def _compile_state(self, state):
+		"""
+		Return brightness & colour temperature commands to recall state, without the 
+		transition time (last two bytes of each command)
+		"""
+		return (self._build_command(COMMAND_BRI, data=struct.pack("<BH", state['bri'], 0))[:-2],
+			self._build_command(COMMAND_TEMP, data=struct.pack("<HH", state['temp'], 0))[:-2])
+
+	def _setting(self, state):
+		"""
+		Return (brightness in percent, colour temperature in kelvin) of state
+		"""
+		return (state['bri'], state['temp'])
+
+	def _payload_commands(self, payload, transition=10):
+		"""
+		Return commands from _compile_state() with transition time appended
+		"""
+		transition = struct.pack("<H", min(transition, 65535))
+		return [command + transition for command in payload]
+
+	def _send_payload(self, payload, transition=10):
+		"""
+		Send commands from _compile_state() with transition time, in one round trip
+		"""
+		logger.debug('Setting brightness and temp of light %s' % (self.name()))
+		commands = self._payload_commands(payload, transition)
+		(bri_ok, temp_ok) = [self._check_rc(response) for response in self._send_commands(commands)]
+		return bri_ok and temp_ok
 
 	def update_state(self, state):
 		"""
@@ -861,6 +2018,20 @@ class _LightifyLight(_Lightify):
 		"""
 		self._state = state
 
+	def saved_state(self):
+		"""
+		Return settings applied when light is switched on
+		"""
+		return self._state
+
+	def _new_state(self, on):
+		"""
+		Return expected state after switching light on with saved settings, or off
+		"""
+		if on:
+			return dict(self._state, on=1)
+		return {'on': 0}
+
 	def set_bri(self, bri, transition=10):
 		"""
 		Set the brightness of the light
@@ -869,7 +2040,7 @@ class _LightifyLight(_Lightify):
 		data = struct.pack("<BH",bri, transition)
 		command = self._build_command(COMMAND_BRI, data=data)
 		response = self._send_command(command)
-		self._check_rc(response)
+		return self._check_rc(response)
 
 	def set_temp(self, temp, transition=10):
 		"""
@@ -879,7 +2050,7 @@ class _LightifyLight(_Lightify):
 		data = struct.pack("<HH", temp, transition)
 		command = self._build_command(COMMAND_TEMP, data=data)
 		response = self._send_command(command)
-		self._check_rc(response)
+		return self._check_rc(response)
 
 	def _on_off(self, on_off):
 		"""
@@ -889,7 +2060,7 @@ class _LightifyLight(_Lightify):
 		data = struct.pack("<B",on_off)
 		command = self._build_command(COMMAND_ONOFF, data=data)
 		response = self._send_command(command)
-		self._check_rc(response)
+		return self._check_rc(response)
 
 	def _build_command(self, command, data=b''):
 		"""
@@ -912,35 +2083,32 @@ class _LightifyLight(_Lightify):
 		# seventh byte of response is a status code; 0 = success, 21 = addr not found	
 		if response[6] == 0:
 			logger.debug('OK')
+			return True
 		else:
 			logger.warning('Operation failed (%s)' % (response[6]))	
+			return False
 
 class LightifyGateway(_Lightify):
 
 	def get_all_lights(self):
 		# query Gateway to get list of all lights with names and addresses
 		self.lights = {}
-		# build command to query Gateway for all light status
-		command = self._build_global_command(COMMAND_ALL_LIGHT_STATUS, 1)
-		# send command and receive response
-		data = self._send_command(command)
-
-		# get number of lights
-		(num,) = struct.unpack("<H", data[7:9])
-		logger.debug('num: %s' % (num))
-		# parse status info for each light from response
-		status_len = 50
-		for i in range(0, num):
-			pos = 9 + i * status_len
-			payload = data[pos:pos+status_len]
-			logger.debug("%s %s %s" % (i, pos, len(payload)))
-			(a, addr, stat, name, extra) = struct.unpack("<HQ16s16sQ", payload)
-			# Decode using cp437 for python3.
-			name = name.decode('cp437').replace('\0', "")
-			logger.info('light: %s %s %s %s' % (a, addr, name, extra))
-			light = _LightifyLight(addr, self._host, name=name)
+		for (addr, name, state) in self._all_light_status():
+			logger.info('light: %s %s' % (addr, name))
+			light = _LightifyLight(addr, self._host, name=name, port=self._port, state=state)
 			self.lights[addr] = light		
 
+	def get_all_light_states(self):
+		"""
+		Return dict from addresses to current states of all lights (one query to Gateway)
+		"""
+		return {addr: state for (addr, name, state) in self._all_light_status()}
+
+	def _all_light_status(self):
+		# query Gateway for status of all lights and return list of (addr, name, state)
+		command = self._build_global_command(COMMAND_ALL_LIGHT_STATUS, 1)
+		return _parse_all_light_status(self._send_command(command))
+
 	def _build_global_command(self, command, flag):
 		length = 7
 		result = struct.pack(
@@ -987,3 +2155,41 @@ class LightifyGateway(_Lightify):
 		logger.debug('Sending: {}'.format(data))
 		response = self._send_command(data)
 		logger.debug('Received: {}'.format(response))
+
+
+# cache of gateways found on each network
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+def find_lightify_gateways(network='192.168.1.0/27', port=LIGHTIFY_PORT, timeout=0.5, workers=32, refresh=False):
+	"""
+	Return sorted list of addresses on network (CIDR, e.g. '192.168.1.0/24') at which a 
+	Lightify Gateway responds to a query for the status of all lights.  Addresses are 
+	probed concurrently using up to `workers` threads.  The result for each network is
+	cached unless refresh is True.
+	"""
+	network = ipaddress.ip_network(network, strict=False)
+	with _gateways_lock:
+		if not refresh and (network, port) in _gateways:
+			return list(_gateways[(network, port)])
+	hosts = list(network.hosts()) or [network.network_address]
+	with concurrent.futures.ThreadPoolExecutor(min(workers, len(hosts))) as executor:
+		found = executor.map(lambda host: _probe_lightify_gateway(str(host), port, timeout), hosts)
+		gateways = [str(host) for host, ok in zip(hosts, found) if ok]
+	logger.debug('Found Lightify Gateways at %s on %s' % (gateways, network))
+	with _gateways_lock:
+		_gateways[(network, port)] = gateways
+	return list(gateways)
+
+def _probe_lightify_gateway(host, port=LIGHTIFY_PORT, timeout=0.5):
+	"""
+	Return True if a Lightify Gateway at host returns a valid light status response
+	"""
+	command = LightifyGateway(host, port)._build_global_command(COMMAND_ALL_LIGHT_STATUS, 1)
+	try:
+		with socket.create_connection((host, port), timeout=timeout) as s:
+			s.sendall(command)
+			_parse_all_light_status(_LightifyConnection._recv(s))
+	except (OSError, RuntimeError, ValueError, struct.error):
+		return False
+	return True
@@ -8,6 +8,10 @@ import signal
 import sys
 import subprocess
 import logging
+import heapq
+import itertools
+import collections
+import queue
 
 # Installed modules
 import paho.mqtt.client as mqtt
@@ -23,39 +27,92 @@ class PresenceSensor():
 	- Callback functions may be set for last-one-out and welcome events.
 	- PresenceSensor.query(beacon_owner) method returns True if beacon registered to
 	  beacon_owner is found, False otherwise
+	- The ibeacon server only forwards adverts from registered beacons, at most once every
+	  advert_interval seconds for each beacon
+	- RSSI of adverts from each beacon is smoothed using an exponentially weighted moving 
+	  average (weight of newest advert rssi_alpha).  A beacon comes in once it has been seen
+	  min_sightings times within sighting_window and its smoothed RSSI is at least enter_rssi.
+	  While in, only adverts with smoothed RSSI of at least exit_rssi count as sightings, so
+	  it goes out scan_timeout after the signal drops below exit_rssi or is lost.
+	- Callbacks are run by a separate thread, so that slow callbacks (e.g. switching 
+	  lights) don't hold up handling of adverts.  The welcome and last-one-out callbacks 
+	  both change the whole house, so they are run one at a time in the order of the 
+	  events.
 	"""
 	# define required iBeacon ID keys
 	BEACON_ID_KEYS = ("UUID", "Major", "Minor")
 	
-	def __init__(self, welcome_callback=None, last_one_out_callback=None, hci='hci0', scan_timeout=datetime.timedelta(seconds=300)):
+	def __init__(self, welcome_callback=None, last_one_out_callback=None, hci='hci0', scan_timeout=datetime.timedelta(seconds=300), advert_interval=1,
+		rssi_alpha=0.3, enter_rssi=None, exit_rssi=None, min_sightings=1, sighting_window=datetime.timedelta(seconds=30)):
 		self.hci = hci
 		self.scan_timeout = scan_timeout
+		self.advert_interval = advert_interval
+		# presence state machine parameters
+		self.rssi_alpha = rssi_alpha
+		self.enter_rssi = enter_rssi
+		self.exit_rssi = exit_rssi
+		self.min_sightings = min_sightings
+		self.sighting_window = sighting_window.total_seconds()
 		# set callback functions (if supplied as arguments)
 		self.welcome_callback = welcome_callback
 		self.last_one_out_callback = last_one_out_callback
+		self.dispatcher = _CallbackDispatcher()
 		
-		self.registered_beacons = []
+		# dict from normalised (UUID, Major, Minor) tuples to registered beacons, and from 
+		# owners to lists of their registered beacons
+		self.registered_beacons = {}
+		self.owners = {}
+
+		# client connected to ibeacon server
+		self.client = None
 		
-		# thread lock
+		# thread lock, and condition used to wake loop when a beacon arrives or on stop
 		self.lock = threading.Lock()
+		self.wakeup = threading.Condition(self.lock)
+
+		# heap of (monotonic expiry time, sequence number, beacon key) for beacons which are
+		# in, and number of beacons which are in
+		self.deadlines = []
+		self._seq = itertools.count()
+		self.beacons_in = 0
 			
 	def register_beacon(self, beacon, owner):
 		# add beacon to list of registered beacons
-		for key in PresenceSensor.BEACON_ID_KEYS:
-			if key not in list(beacon.keys()): 
-				return "Failed to register beacon (missing or invalid ID)"
-		if self._get_beacon(beacon) == None:
-			self.registered_beacons.append({"owner": owner, "ID": beacon, "last_seen": datetime.datetime.now(), "in": False})
+		try:
+			key = self._beacon_key(beacon)
+		except (KeyError, ValueError, AttributeError):
+			return "Failed to register beacon (missing or invalid ID)"
+		if key not in self.registered_beacons:
+			b = {"owner": owner, "ID": beacon, "last_seen": datetime.datetime.now(), "last_seen_mono": time.monotonic(), "in": False,
+				# smoothed RSSI and monotonic times of the most recent adverts
+				"rssi": None, "adverts": collections.deque(maxlen=self.min_sightings)}
+			with self.lock:
+				self.registered_beacons[key] = b
+				self.owners.setdefault(owner, []).append(b)
+			self._subscribe()
 			return "Registered beacon %s to owner %s" % (beacon, owner)
 
 	def deregister_beacon(self, beacon):
-		self.registered_beacons.remove(self._get_beacon(beacon))
+		b = self._get_beacon(beacon)
+		if b is None:
+			return "Failed to deregister beacon %s (not registered)" % (beacon)
+		with self.lock:
+			del self.registered_beacons[self._beacon_key(beacon)]
+			if b['in']:
+				self.beacons_in -= 1
+			self.owners[b['owner']].remove(b)
+			if len(self.owners[b['owner']]) == 0:
+				del self.owners[b['owner']]
+		self._subscribe()
 		return "Deregistered beacon %s" % (beacon)
 
 	def start(self):
 		logger.info("Starting Presence Sensor...")
 		self.on = True
 
+		# start threads to run callbacks
+		self.dispatcher.start()
+
 		# start client and connect to ibeacon server
 		self.client_thread = threading.Thread(target=self._client)
 		self.client_thread.start()
@@ -66,61 +123,176 @@ class PresenceSensor():
 
 	def stop(self):
 		logger.info("Stopping Presence Sensor...")
-		self.on = False
+		with self.wakeup:
+			self.on = False
+			self.wakeup.notify()
 		# To-do: stop client thread
 		self.loop_thread.join()
+		self.dispatcher.stop()
 		logger.debug("Presence Sensor stopped")
 
+	def callback_stats(self):
+		"""
+		Return number of callbacks run, and mean and maximum latency in seconds from event 
+		to completion of callback
+		"""
+		return self.dispatcher.stats()
+
 	def query(self, beacon_owner=None):
 		if beacon_owner is None:
-			occupied = False
-			for b in self.registered_beacons:
-				if b['in']: occupied = True
-			return occupied
+			return any(b['in'] for b in list(self.registered_beacons.values()))
 		else:
-			for b in self.registered_beacons:
-				if b['owner'] == beacon_owner:
-					return b['in']
+			try:
+				return any(b['in'] for b in self.owners[beacon_owner])
+			except KeyError:
+				return None
 
 	def _client(self):
-		# start client and connect to ibeacon server
+		# start client and connect to ibeacon server, subscribing to adverts from registered beacons
 		server_address = ('localhost', 9999)
-		self.client = ibeacon.Client(server_address, on_message=self._handle_message)
+		ibeacon.Client(server_address, on_message=self._handle_message, binary=True,
+			subscribe=[b['ID'] for b in self.registered_beacons.values()], interval=self.advert_interval,
+			on_connect=self._on_connect)
+
+	def _on_connect(self, client):
+		self.client = client
+
+	def _subscribe(self):
+		# update subscription if already connected to ibeacon server
+		if self.client is not None:
+			self.client.subscribe([b['ID'] for b in self.registered_beacons.values()], interval=self.advert_interval)
 	
 	def _loop(self):
+		"""
+		Set 'in' to False for each beacon not seen for > scan_timeout.  Call 
+		last_one_out_callback() when the last beacon which was in times out.
+		Sleeps until the earliest time at which a beacon could time out.  Deadlines are
+		re-armed lazily, i.e. a beacon seen since its deadline was set is pushed back on to
+		the heap with a new deadline when the old one expires.
+		"""
 		logger.debug("Starting loop...")
+		scan_timeout = self.scan_timeout.total_seconds()
 		while self.on:
-			# if each beacon not seen for > SCAN_TIMEOUT then set 'in' to False. Call 
-			# last_one_out_callback() first time no beacons found after timeout.
-			now = datetime.datetime.now()
-			beacons_found = 0
-			with self.lock:
-				for b in self.registered_beacons:
-					if now - b['last_seen'] > self.scan_timeout:
-						if b['in']: logger.info(('[%s] Bye %s!' % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), b['owner'])))
-						b['in'] = False
+			last_one_out = False
+			with self.wakeup:
+				now = time.monotonic()
+				while self.deadlines and self.deadlines[0][0] <= now:
+					(expires, seq, key) = heapq.heappop(self.deadlines)
+					b = self.registered_beacons.get(key)
+					if (b is None) or (not b['in']):
+						continue
+					expires = b['last_seen_mono'] + scan_timeout
+					if expires > now:
+						heapq.heappush(self.deadlines, (expires, next(self._seq), key))
+						continue
+					b['in'] = False
+					self.beacons_in -= 1
+					logger.info(('[%s] Bye %s!' % ((b['last_seen'] + self.scan_timeout).strftime('%Y-%m-%d %H:%M:%S'), b['owner'])))
+					if self.beacons_in == 0:
+						last_one_out = True
+				if not last_one_out and self.on:
+					if self.deadlines:
+						self.wakeup.wait(self.deadlines[0][0] - now)
 					else:
-						beacons_found += 1
-			if (beacons_found == 0) and (beacons_found_last_loop > 0):
-					self.last_one_out_callback()
-			beacons_found_last_loop = beacons_found
-			time.sleep(0.1)
+						self.wakeup.wait()
+			if last_one_out and self.last_one_out_callback is not None:
+				self.dispatcher.emit(self.last_one_out_callback)
 	
 	def _handle_message(self, message):
 		# parse beacon IDs from message and fetch beacon from registered list
 		beacon = self._get_beacon(message)
 		# if beacon is registered
 		if (beacon != None):
-			# update last seen datetime and set 'in' to True
-			with self.lock:
+			with self.wakeup:
+				now = time.monotonic()
+				adverts = beacon['adverts']
+				# update smoothed RSSI, restarting if beacon has not been seen for a while
+				rssi = message.get('RSSI')
+				if rssi is not None:
+					if (beacon['rssi'] is None) or (adverts and now - adverts[-1] > self.sighting_window):
+						beacon['rssi'] = float(rssi)
+					else:
+						beacon['rssi'] += self.rssi_alpha * (rssi - beacon['rssi'])
+				adverts.append(now)
+				if beacon['in']:
+					if (self.exit_rssi is not None) and (beacon['rssi'] is not None) and (beacon['rssi'] < self.exit_rssi):
+						# signal too weak to count as a sighting
+						return
+				else:
+					if (len(adverts) < self.min_sightings) or (now - adverts[0] > self.sighting_window):
+						return
+					if (self.enter_rssi is not None) and (beacon['rssi'] is not None) and (beacon['rssi'] < self.enter_rssi):
+						return
+				# update last seen time and set 'in' to True
 				beacon['last_seen'] = datetime.datetime.now()
-				logger.debug("Beacon %s seen at %s" % (beacon['ID'], beacon['last_seen'].strftime('%Y-%m-%d %H:%M:%S')))
+				beacon['last_seen_mono'] = now
+				logger.debug("Beacon %s seen at %s (RSSI: %.1f)" % (beacon['ID'], beacon['last_seen'].strftime('%Y-%m-%d %H:%M:%S'), beacon['rssi'] or 0))
 				if beacon['in'] == False:
 					beacon['in'] = True		
-					self.welcome_callback(beacon['owner'])
+					self.beacons_in += 1
+					# arm departure deadline and wake loop to reschedule
+					heapq.heappush(self.deadlines, (now + self.scan_timeout.total_seconds(), next(self._seq), self._beacon_key(beacon['ID'])))
+					self.wakeup.notify()
+					if self.welcome_callback is not None:
+						self.dispatcher.emit(self.welcome_callback, beacon['owner'])
 
 	def _get_beacon(self, beacon):
-		for b in self.registered_beacons:
-			if b['ID']['Minor'] == beacon['Minor'] and b['ID']['Major'] == beacon['Major'] and b['ID']['UUID'] == beacon['UUID']:
-				return b
-		return None
+		try:
+			return self.registered_beacons.get(self._beacon_key(beacon))
+		except (KeyError, ValueError, AttributeError):
+			return None
+
+	@staticmethod
+	def _beacon_key(beacon):
+		# normalise beacon IDs, e.g. from registration or advert, to (UUID, Major, Minor)
+		return (beacon['UUID'].upper(), int(beacon['Major']), int(beacon['Minor']))
+
+
+class _CallbackDispatcher():
+	"""
+	Run callbacks for presence events in order on a worker thread
+	"""
+	def __init__(self):
+		self.queue = queue.Queue()
+		self.thread = None
+		# callback latency metrics
+		self.lock = threading.Lock()
+		self.count = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+
+	def start(self):
+		self.thread = threading.Thread(target=self._worker)
+		self.thread.start()
+
+	def stop(self):
+		self.queue.put(None)
+		self.thread.join()
+
+	def emit(self, callback, *args):
+		"""
+		Queue callback to be called with the supplied arguments
+		"""
+		self.queue.put((time.monotonic(), callback, args))
+
+	def stats(self):
+		with self.lock:
+			mean = self.total_latency / self.count if self.count else 0.0
+			return {'count': self.count, 'mean_latency': mean, 'max_latency': self.max_latency}
+
+	def _worker(self):
+		while True:
+			event = self.queue.get()
+			if event is None:
+				break
+			(emitted, callback, args) = event
+			try:
+				callback(*args)
+			except Exception:
+				logger.exception('Presence callback %s failed' % (callback))
+			latency = time.monotonic() - emitted
+			logger.debug('Presence callback %s completed in %.3f s' % (getattr(callback, '__name__', callback), latency))
+			with self.lock:
+				self.count += 1
+				self.total_latency += latency
+				self.max_latency = max(self.max_latency, latency)
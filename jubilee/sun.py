@@ -0,0 +1,135 @@
+"""
+Offline calculation of the position of the sun, and sunrise, sunset and twilight times,
+using the NOAA solar calculator algorithm (accurate to about a minute between latitudes
++/- 72 degrees).
+Reference: https://gml.noaa.gov/grad/solcalc/calcdetails.html
+"""
+
+# Built-in modules
+import math
+import datetime
+import array
+
+# elevation of the centre of the sun in degrees at sunrise/sunset (allowing for refraction
+# and the radius of the sun), and at the start/end of each kind of twilight
+SUNRISE = -0.833
+CIVIL = -6.0
+NAUTICAL = -12.0
+ASTRONOMICAL = -18.0
+
+# Julian day at midnight UTC on day 0 of the proleptic Gregorian calendar (date.toordinal)
+_ORDINAL_JD = 1721424.5
+
+def julian_day(when):
+	"""
+	Return Julian day for a naive UTC datetime (or date, at midnight UTC)
+	"""
+	jd = when.toordinal() + _ORDINAL_JD
+	if isinstance(when, datetime.datetime):
+		jd += (when.hour * 3600 + when.minute * 60 + when.second + when.microsecond / 1e6) / 86400
+	return jd
+
+def solar_position(jd):
+	"""
+	Return (declination in degrees, equation of time in minutes) of the sun at Julian day jd
+	"""
+	T = (jd - 2451545) / 36525
+	L0 = math.radians((280.46646 + T * (36000.76983 + T * 0.0003032)) % 360)
+	M = math.radians(357.52911 + T * (35999.05029 - 0.0001537 * T))
+	e = 0.016708634 - T * (0.000042037 + 0.0000001267 * T)
+	# equation of centre and apparent longitude
+	C = (math.sin(M) * (1.914602 - T * (0.004817 + 0.000014 * T)) + math.sin(2 * M) * (0.019993 - 0.000101 * T)
+		+ math.sin(3 * M) * 0.000289)
+	omega = math.radians(125.04 - 1934.136 * T)
+	apparent_long = math.radians(math.degrees(L0) + C - 0.00569 - 0.00478 * math.sin(omega))
+	# obliquity of the ecliptic
+	mean_obliquity = 23 + (26 + (21.448 - T * (46.815 + T * (0.00059 - T * 0.001813))) / 60) / 60
+	obliquity = math.radians(mean_obliquity + 0.00256 * math.cos(omega))
+	declination = math.degrees(math.asin(math.sin(obliquity) * math.sin(apparent_long)))
+	y = math.tan(obliquity / 2) ** 2
+	eot = 4 * math.degrees(y * math.sin(2 * L0) - 2 * e * math.sin(M) + 4 * e * y * math.sin(M) * math.cos(2 * L0)
+		- 0.5 * y * y * math.sin(4 * L0) - 1.25 * e * e * math.sin(2 * M))
+	return (declination, eot)
+
+def elevation(when, lat, lon):
+	"""
+	Return elevation of the sun in degrees above the horizon at a naive UTC datetime, for
+	latitude lat and longitude lon (degrees, east positive), without allowing for refraction
+	"""
+	(declination, eot) = solar_position(julian_day(when))
+	minutes = when.hour * 60 + when.minute + (when.second + when.microsecond / 1e6) / 60
+	hour_angle = math.radians((minutes + eot + 4 * lon) / 4 - 180)
+	lat = math.radians(lat)
+	declination = math.radians(declination)
+	cos_zenith = math.sin(lat) * math.sin(declination) + math.cos(lat) * math.cos(declination) * math.cos(hour_angle)
+	return 90 - math.degrees(math.acos(max(-1.0, min(1.0, cos_zenith))))
+
+def crossing_minutes(date, lat, lon, elevation=SUNRISE):
+	"""
+	Return (rising, setting) times in minutes after midnight UTC on date at which the centre
+	of the sun crosses the given elevation, or (nan, nan) if it doesn't on that date
+	"""
+	# position of the sun at approximate solar noon
+	(declination, eot) = solar_position(julian_day(date) + 0.5 - lon / 360)
+	noon = 720 - 4 * lon - eot
+	lat = math.radians(lat)
+	declination = math.radians(declination)
+	cos_hour_angle = ((math.cos(math.radians(90 - elevation)) - math.sin(lat) * math.sin(declination))
+		/ (math.cos(lat) * math.cos(declination)))
+	if not -1 <= cos_hour_angle <= 1:
+		return (float('nan'), float('nan'))
+	half_day = 4 * math.degrees(math.acos(cos_hour_angle))
+	return (noon - half_day, noon + half_day)
+
+def crossing_times(date, lat, lon, elevation=SUNRISE):
+	"""
+	Return (rising, setting) naive UTC datetimes on date at which the centre of the sun
+	crosses the given elevation (None if it doesn't on that date)
+	"""
+	midnight = datetime.datetime(date.year, date.month, date.day)
+	return tuple(None if math.isnan(m) else midnight + datetime.timedelta(minutes=m) for m in crossing_minutes(date, lat, lon, elevation))
+
+
+class SunTable():
+	"""
+	Table of sunrise, sunset and twilight times for every day of a year at one location,
+	computed when created.  Times are stored in arrays of minutes after midnight UTC,
+	indexed by day of year (nan if the event doesn't happen on that day).
+	"""
+	# names of rising and setting events for each elevation
+	EVENTS = (
+		('sunrise', 'sunset', SUNRISE),
+		('civil_dawn', 'civil_dusk', CIVIL),
+		('nautical_dawn', 'nautical_dusk', NAUTICAL)
+	)
+
+	def __init__(self, year, lat, lon):
+		self.year = year
+		self.lat = float(lat)
+		self.lon = float(lon)
+		self.tables = {}
+		for (rising, setting, angle) in self.EVENTS:
+			self.tables[rising] = array.array('d')
+			self.tables[setting] = array.array('d')
+		day = datetime.date(year, 1, 1)
+		while day.year == year:
+			for (rising, setting, angle) in self.EVENTS:
+				(rise, set_) = crossing_minutes(day, self.lat, self.lon, angle)
+				self.tables[rising].append(rise)
+				self.tables[setting].append(set_)
+			day += datetime.timedelta(days=1)
+
+	def times(self, date):
+		"""
+		Return dict from event names to naive UTC datetimes on date (None if the event
+		doesn't happen on that date)
+		"""
+		if date.year != self.year:
+			raise ValueError('Date %s not in table for %s' % (date, self.year))
+		index = date.timetuple().tm_yday - 1
+		midnight = datetime.datetime(date.year, date.month, date.day)
+		times = {}
+		for name, table in self.tables.items():
+			minutes = table[index]
+			times[name] = None if math.isnan(minutes) else midnight + datetime.timedelta(minutes=minutes)
+		return times
@@ -89,7 +89,7 @@ def run():
 			got_button(bd_addr)
 	
 	# initialise lights bridge
-	bridge = lights.Bridge(hue_uname=config.HUE_USERNAME, lightify=True)
+	bridge = lights.Bridge(hue_uname=config.HUE_USERNAME, lightify=True, fast_start=True)
 	
 	# load flic button groups from file
 	with open(config.FLIC_BUTTONS) as f:
@@ -104,7 +104,7 @@ def run():
 	flic_thread = threading.Thread(target=flic_client.handle_events)
 	flic_thread.start()
 	
-	# initialise daylight sensor (daylight times from sunrise-sunset.org API)
+	# initialise daylight sensor (daylight times calculated locally)
 	daylight_sensor = lights.DaylightSensor(lat=config.LATITUDE, lon=config.LONGITUDE)
 	print('Sunrise and sunset times... OK')
 	
@@ -125,9 +125,9 @@ def run():
 	print(' OK')
 
 	while True:
-		# loop controller to check if any actions should be triggered
+		# trigger any actions which are due, then sleep until the next one
 		controller.loop_once()
-		time.sleep(1)
+		controller.sleep_until_next()
 
 if __name__ == "__main__":
 	try: